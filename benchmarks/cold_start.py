@@ -0,0 +1,85 @@
+"""Cold-start timings: app import, first /health and first /check, each in a fresh interpreter
+
+Usage: python benchmarks/cold_start.py [--runs 5] [--latency 0.05]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CODE1 = "def total(values):\n    result = 0\n    for value in values:\n        result += value\n    return result\n"
+CODE2 = "def add_all(items):\n    acc = 0\n    for item in items:\n        acc += item\n    return acc\n"
+
+def measure_child(latency):
+    """Runs inside the fresh interpreter and prints one JSON line of timings"""
+    started = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    import main
+    imported = time.perf_counter()
+    
+    from benchmarks.stubs import StubProviders
+    StubProviders(latency).install(main)
+    client = main.app.test_client()
+    
+    assert client.get('/health').status_code == 200
+    first_health = time.perf_counter()
+    assert client.post('/check', json={'code1': CODE1, 'code2': CODE2}).status_code == 200
+    first_check = time.perf_counter()
+    
+    print(json.dumps({
+        'import_seconds': imported - started,
+        'first_health_seconds': first_health - started,
+        'first_check_seconds': first_check - started
+    }))
+
+def run_once(latency):
+    with tempfile.TemporaryDirectory() as store_dir:
+        env = dict(os.environ)
+        # Fresh, throwaway stores so runs neither read nor pollute real data
+        for name in ('EMBEDDING_CACHE_PATH', 'FINGERPRINT_INDEX_PATH', 'SUBTREE_INDEX_PATH',
+                     'SUBMISSION_INDEX_PATH', 'JOB_STORE_PATH'):
+            env[name] = os.path.join(store_dir, name.lower() + '.db')
+        env.setdefault('COHERE_API_KEY', 'benchmark')
+        env.setdefault('TOGETHER_API_KEY', 'benchmark')
+        
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', '--latency', str(latency)],
+            cwd=ROOT, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        process_seconds = time.perf_counter() - started
+    
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings['process_seconds'] = process_seconds
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0, help='stub provider latency in seconds')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.child:
+        measure_child(args.latency)
+        return
+    
+    runs = [run_once(args.latency) for _ in range(args.runs)]
+    report = {'runs': args.runs, 'provider_latency_seconds': args.latency}
+    for key in runs[0]:
+        values = [run[key] for run in runs]
+        report[key] = {
+            'median': round(statistics.median(values), 4),
+            'min': round(min(values), 4),
+            'max': round(max(values), 4)
+        }
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
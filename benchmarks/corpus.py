@@ -0,0 +1,146 @@
+"""Seeded synthetic corpora: original programs and controlled plagiarized variants"""
+import ast
+import builtins
+import keyword
+import random
+
+WORDS = [
+    'total', 'count', 'items', 'values', 'result', 'index', 'buffer', 'record', 'score', 'limit',
+    'offset', 'node', 'entry', 'state', 'weight', 'size', 'name', 'key', 'queue', 'stack',
+    'window', 'delta', 'label', 'price', 'order', 'user', 'token', 'block', 'chunk', 'row'
+]
+VERBS = ['compute', 'build', 'merge', 'filter', 'collect', 'scan', 'update', 'parse', 'rank', 'split']
+
+TRANSFORMS = ('rename', 'reorder', 'comments', 'whitespace')
+
+def _identifier(rng, used):
+    while True:
+        name = '_'.join(rng.sample(WORDS, rng.choice((1, 2))))
+        if name not in used:
+            used.add(name)
+            return name
+
+def _statements(rng, params, used, depth=0):
+    """A few statement templates that cover loops, branches, comprehensions and calls"""
+    acc = _identifier(rng, used)
+    item = _identifier(rng, used)
+    source = rng.choice(params)
+    templates = [
+        [f'{acc} = 0', f'for {item} in {source}:', f'    if {item} > {rng.randint(0, 9)}:',
+         f'        {acc} += {item} * {rng.randint(2, 5)}', '    else:', f'        {acc} -= 1'],
+        [f'{acc} = [{item} for {item} in {source} if {item} % {rng.randint(2, 4)} == 0]',
+         f'{acc}.sort(reverse={rng.choice(("True", "False"))})'],
+        [f'{acc} = {{}}', f'for {item} in {source}:', f'    {acc}[{item}] = {acc}.get({item}, 0) + 1'],
+        [f'{acc} = len({source})', f'while {acc} > {rng.randint(1, 5)}:', f'    {acc} //= 2'],
+        [f'{acc} = []', f'for {item} in range(len({source})):',
+         f'    {acc}.append({source}[{item}] if {item} % 2 else -{source}[{item}])'],
+    ]
+    lines = rng.choice(templates)
+    if depth == 0 and rng.random() < 0.5:
+        lines = lines + _statements(rng, params, used, depth + 1)
+    return lines
+
+def generate_program(rng, functions=None):
+    used = set()
+    blocks = []
+    for _ in range(functions or rng.randint(3, 6)):
+        name = f'{rng.choice(VERBS)}_{_identifier(rng, used)}'
+        params = [_identifier(rng, used) for _ in range(rng.randint(1, 3))]
+        body = _statements(rng, params, used)
+        returned = body[0].split(' = ')[0]
+        lines = [f"def {name}({', '.join(params)}):"]
+        lines += ['    ' + line for line in body]
+        lines.append(f'    return {returned}')
+        blocks.append('\n'.join(lines))
+    return '\n\n\n'.join(blocks) + '\n'
+
+class _Renamer(ast.NodeTransformer):
+    """Consistently renames every user-defined identifier"""
+    
+    def __init__(self, rng):
+        self.rng = rng
+        self.mapping = {}
+        self.reserved = set(keyword.kwlist) | set(dir(builtins)) | {'append', 'get', 'sort'}
+    
+    def rename(self, name):
+        if name in self.reserved:
+            return name
+        if name not in self.mapping:
+            self.mapping[name] = f'{self.rng.choice(("v", "tmp", "x", "val", "obj"))}{len(self.mapping)}'
+        return self.mapping[name]
+    
+    def visit_FunctionDef(self, node):
+        node.name = self.rename(node.name)
+        self.generic_visit(node)
+        return node
+    
+    def visit_arg(self, node):
+        node.arg = self.rename(node.arg)
+        return node
+    
+    def visit_Name(self, node):
+        node.id = self.rename(node.id)
+        return node
+
+def plagiarize(source, rng, transforms=TRANSFORMS):
+    """Apply the given transforms in a fixed order so each variant is reproducible"""
+    tree = ast.parse(source)
+    if 'rename' in transforms:
+        tree = _Renamer(rng).visit(tree)
+    if 'reorder' in transforms:
+        rng.shuffle(tree.body)
+    lines = ast.unparse(tree).splitlines()
+    
+    if 'comments' in transforms:
+        commented = []
+        for line in lines:
+            if line.startswith('def ') and rng.random() < 0.8:
+                commented.append(f'# {rng.choice(VERBS)} the {rng.choice(WORDS)} here')
+            commented.append(line)
+            if line.rstrip().endswith(':') and rng.random() < 0.3:
+                indent = len(line) - len(line.lstrip()) + 4
+                commented.append(' ' * indent + f'# {rng.choice(WORDS)} step')
+        lines = commented
+    
+    if 'whitespace' in transforms:
+        spaced = []
+        for line in lines:
+            spaced.append(line.replace(' = ', '  =  ', 1) if rng.random() < 0.3 else line)
+            if line.startswith('    return') or rng.random() < 0.1:
+                spaced.append('')
+        lines = spaced
+    
+    return '\n'.join(lines) + '\n'
+
+def build_corpus(originals=20, variants_per_original=2, seed=1234):
+    """Originals, their variants and labelled pairs (plagiarized and unrelated)"""
+    rng = random.Random(seed)
+    documents = []
+    pairs = []
+    
+    for number in range(originals):
+        original = generate_program(rng)
+        original_id = f'orig-{number}'
+        documents.append({'id': original_id, 'code': original, 'source': None, 'transforms': []})
+        
+        for variant in range(variants_per_original):
+            # First variant gets every transform; later ones a random subset
+            transforms = TRANSFORMS if variant == 0 else tuple(
+                t for t in TRANSFORMS if rng.random() < 0.5
+            ) or ('whitespace',)
+            variant_id = f'{original_id}-var-{variant}'
+            documents.append({
+                'id': variant_id,
+                'code': plagiarize(original, rng, transforms),
+                'source': original_id,
+                'transforms': list(transforms)
+            })
+            pairs.append({'code1': original_id, 'code2': variant_id, 'label': 'plagiarized'})
+    
+    original_ids = [doc['id'] for doc in documents if doc['source'] is None]
+    for number, original_id in enumerate(original_ids):
+        other = original_ids[(number + 1) % len(original_ids)]
+        if other != original_id:
+            pairs.append({'code1': original_id, 'code2': other, 'label': 'unrelated'})
+    
+    return documents, pairs
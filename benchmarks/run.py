@@ -0,0 +1,243 @@
+"""In-process load benchmark over a synthetic plagiarism corpus with stub providers
+
+Usage: python benchmarks/run.py [--originals 20] [--latency 0.05] [--concurrency 4] [--output report.json]
+
+Prints one JSON report: per-scenario latency percentiles and requests per second,
+per-stage timings, peak memory and the score separation between plagiarized and
+unrelated pairs.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.corpus import build_corpus
+from benchmarks.stubs import StubProviders
+
+SCENARIOS = ('check', 'analyze', 'detailed-check', 'batch-check', 'batch-analyze')
+
+class StageTimer:
+    """Accumulates wall time of wrapped functions; nested stages are counted in both"""
+    
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+    
+    def wrap(self, owner, attribute, stage):
+        original = getattr(owner, attribute)
+        
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self.totals[stage] += elapsed
+                    self.calls[stage] += 1
+        
+        setattr(owner, attribute, timed)
+    
+    def reset(self):
+        with self._lock:
+            self.totals.clear()
+            self.calls.clear()
+    
+    def report(self):
+        with self._lock:
+            return {
+                stage: {
+                    'calls': self.calls[stage],
+                    'total_seconds': round(total, 4),
+                    'mean_ms': round(total / self.calls[stage] * 1000, 3)
+                }
+                for stage, total in sorted(self.totals.items())
+            }
+
+def instrument(main, timer):
+    analyzer, code_analyzer = main.analyzer, main.code_analyzer
+    timer.wrap(analyzer, '_request_cohere_embeddings', 'provider.cohere')
+    timer.wrap(analyzer, '_request_together_embeddings', 'provider.together')
+    timer.wrap(analyzer, 'calculate_similarity', 'similarity.pair')
+    timer.wrap(analyzer, 'get_replicate_similarity', 'similarity.fingerprint')
+    timer.wrap(analyzer, 'batch_similarity', 'similarity.batch')
+    timer.wrap(analyzer, 'candidate_similarity', 'similarity.candidates')
+    timer.wrap(code_analyzer, 'analyze_code_structure', 'analysis.structure')
+    timer.wrap(code_analyzer, 'detect_ai_generated_code', 'analysis.ai_detection')
+    timer.wrap(main, 'analyze_batch', 'analysis.batch')
+    timer.wrap(main, 'register_submissions', 'index.register')
+
+class BackgroundTracker:
+    """Records work the routes hand to the registration pool so each scenario can wait for it"""
+    
+    def __init__(self, executor):
+        self.futures = []
+        self._lock = threading.Lock()
+        self._submit = executor.submit
+        executor.submit = self.submit
+    
+    def submit(self, *args, **kwargs):
+        future = self._submit(*args, **kwargs)
+        with self._lock:
+            self.futures.append(future)
+        return future
+    
+    def drain(self):
+        with self._lock:
+            futures, self.futures = self.futures, []
+        wait(futures)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    position = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[position]
+
+def build_requests(scenario, documents, pairs, batch_size):
+    by_id = {doc['id']: doc['code'] for doc in documents}
+    if scenario in ('check', 'detailed-check'):
+        return [('/' + scenario, {'code1': by_id[p['code1']], 'code2': by_id[p['code2']]}) for p in pairs]
+    if scenario == 'analyze':
+        return [('/analyze', {'code': doc['code']}) for doc in documents]
+    submissions = [{'id': doc['id'], 'code': doc['code']} for doc in documents]
+    batches = [submissions[start:start + batch_size] for start in range(0, len(submissions), batch_size)]
+    return [('/' + scenario, {'submissions': batch}) for batch in batches if len(batch) > 1]
+
+def run_scenario(client, timer, background, requests_to_send, concurrency, trace_memory):
+    timer.reset()
+    if trace_memory:
+        tracemalloc.start()
+    
+    def send(item):
+        path, payload = item
+        started = time.perf_counter()
+        response = client.post(path, json=payload)
+        return time.perf_counter() - started, response.status_code, response.get_json()
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(send, requests_to_send))
+    wall = time.perf_counter() - started
+    # Index registration happens after the response; it is timed as its own stage, not as latency
+    background.drain()
+    background_seconds = time.perf_counter() - started - wall
+    
+    latencies = sorted(latency for latency, _, _ in outcomes)
+    report = {
+        'requests': len(outcomes),
+        'errors': sum(1 for _, status, _ in outcomes if status >= 400),
+        'wall_seconds': round(wall, 4),
+        'requests_per_second': round(len(outcomes) / wall, 2) if wall else None,
+        'background_drain_seconds': round(background_seconds, 4),
+        'latency_ms': {
+            name: round(percentile(latencies, fraction) * 1000, 3)
+            for name, fraction in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))
+        } if latencies else {},
+        'stages': timer.report(),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+    if trace_memory:
+        report['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        tracemalloc.stop()
+    return report, outcomes
+
+def score_separation(pairs, outcomes, score_of):
+    """Mean score per pair label, so a detection-quality regression is visible next to speed"""
+    scores = defaultdict(list)
+    for pair, (_, status, body) in zip(pairs, outcomes):
+        if status == 200:
+            scores[pair['label']].append(score_of(body))
+    return {label: round(sum(values) / len(values), 2) for label, values in scores.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--originals', type=int, default=20)
+    parser.add_argument('--variants', type=int, default=2, help='plagiarized variants per original')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--latency', type=float, default=0.05, help='stub provider latency in seconds')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=200, help='submissions per batch request')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--no-cache', action='store_true', help='disable the embedding cache')
+    parser.add_argument('--trace-memory', action='store_true', help='tracemalloc peaks (slows timings)')
+    parser.add_argument('--output', help='write the report here instead of stdout')
+    args = parser.parse_args()
+    
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    
+    store_dir = tempfile.TemporaryDirectory()
+    # Throwaway stores, configured before the app module reads its environment
+    for name in ('EMBEDDING_CACHE_PATH', 'FINGERPRINT_INDEX_PATH', 'SUBTREE_INDEX_PATH',
+                 'SUBMISSION_INDEX_PATH', 'JOB_STORE_PATH'):
+        os.environ[name] = os.path.join(store_dir.name, name.lower() + '.db')
+    if args.no_cache:
+        os.environ['EMBEDDING_CACHE_SIZE'] = '0'
+        os.environ['EMBEDDING_CACHE_PATH'] = ''
+    os.environ.setdefault('COHERE_API_KEY', 'benchmark')
+    os.environ.setdefault('TOGETHER_API_KEY', 'benchmark')
+    
+    import_started = time.perf_counter()
+    import main as app_module
+    import_seconds = time.perf_counter() - import_started
+    
+    stubs = StubProviders(args.latency).install(app_module)
+    timer = StageTimer()
+    instrument(app_module, timer)
+    background = BackgroundTracker(app_module.registration_executor)
+    client = app_module.app.test_client()
+    
+    documents, pairs = build_corpus(args.originals, args.variants, args.seed)
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'corpus': {'documents': len(documents), 'pairs': len(pairs)},
+        'import_seconds': round(import_seconds, 4),
+        'scenarios': {}
+    }
+    
+    for scenario in scenarios:
+        requests_to_send = build_requests(scenario, documents, pairs, args.batch_size)
+        calls_before = dict(stubs.calls)
+        result, outcomes = run_scenario(client, timer, background, requests_to_send,
+                                        args.concurrency, args.trace_memory)
+        result['provider_calls'] = {
+            name: count - calls_before.get(name, 0) for name, count in stubs.calls.items()
+        }
+        if scenario == 'check':
+            result['mean_score'] = score_separation(pairs, outcomes, lambda body: body['FinalVerdict'])
+        elif scenario == 'detailed-check':
+            result['mean_score'] = score_separation(
+                pairs, outcomes, lambda body: body['similarity']['combined_score'])
+        report['scenarios'][scenario] = result
+    
+    report['embedding_cache'] = app_module.embedding_cache.stats()
+    store_dir.cleanup()
+    
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
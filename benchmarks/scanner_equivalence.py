@@ -0,0 +1,257 @@
+"""Equivalence check: CodeFeatureScanner against the regex-based feature extraction it replaced
+
+Usage: python benchmarks/scanner_equivalence.py [--stdlib 500] [--fuzz 5000] [--seed 1234]
+
+Compares every field of CodeFeatureScanner.scan with the original per-method regex code on
+fixed adversarial inputs, the synthetic benchmark corpus, standard library modules and seeded
+fuzzed snippets. Exits non-zero and prints the first differences if any input disagrees.
+"""
+import argparse
+import glob
+import math
+import os
+import random
+import re
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.corpus import build_corpus
+
+# Inputs aimed at the places where the scanner departs from the regexes: step sequences in place
+# of DOTALL `.*?`, the anchored constant pattern, quote counting for docstrings and the one-pass
+# line counters. Pathological shapes are kept small here; the baseline is quadratic on them.
+ADVERSARIAL = [
+    '',
+    '\n',
+    '\n\n\n',
+    '   \n\t\n',
+    '"""',
+    '""""',
+    '"""""',
+    '""""""',
+    '"""a""" """b',
+    '"""\n"""\n"""',
+    'def f():\n    """doc"""',
+    'def f(x):\n    pass\n"""late"""',
+    'def f(a, b)\n    ):\n """x',
+    'def f():"""',
+    'def\tf(\n):\t"""x"""',
+    'def f():\n    return 1\n):\n"""x"""',
+    'try:\n    x = 1\nexcept ValueError:\n    pass',
+    'try:   \t\n    pass\nexcept',
+    'try:\n    pass\nexcept Exception',
+    'except:\ntry:\n',
+    'try: x()\nexcept:\n    pass',
+    'try:\r\nexcept:',
+    'try:\n' + '\n' * 50 + 'except' + ' ' * 50 + ':',
+    'import os\nimport sys',
+    'import os   \n\n\n    import sys',
+    'import os \t \n',
+    'import os\n' + '\n' * 200 + 'x = 1',
+    'import os\n' + '\n' * 200 + 'import sys',
+    'import os\r\nimport sys',
+    'from os import path\nimport sys',
+    "print(f'{x}')",
+    "f'no braces'",
+    "f'{'",
+    "f'}{'",
+    'f"{\n}"',
+    "'{}'.format(x)",
+    '.format (x)',
+    'list()',
+    'list(',
+    'list(' * 200,
+    'dict(a=1',
+    'dict(a=1\n)',
+    ')list(',
+    'if __name__ == "__main__":',
+    "if __name__=='__main__':",
+    'if __name__ == "__main__"',
+    '# This function adds',
+    '#This function adds',
+    '# Initialize\n# Create\n# Set up',
+    '    # Set up things',
+    'AB = 1',
+    'A = 1',
+    '_A = 1',
+    'AB= 1\nCD =2\nEF\n=3',
+    'aAB = 1',
+    'A' * 300 + ' = 1',
+    'A' * 300 + ' == 1',
+    'A_B_C_D_E' * 40 + 'x = 1',
+    'ÀB = 1',
+    'x = 1',
+    'x=1',
+    'xy = 1',
+    'é = 1',
+    'x == 1',
+    'def snake_case(): pass',
+    'def camelCase(): pass',
+    'def CamelCase(): pass',
+    'def _private_thing(): pass',
+    'def abc(): pass\ndef abcd(): pass',
+    'def f(): pass; def g_h(): pass',
+    'undefined = 1\nindef x',
+    'def ünïcode_name(): pass',
+    'def\n    f(): pass',
+    '\tdef tabbed():\n\t\treturn 1',
+    'def f():\n    return 1\n' * 20,
+    '# one\n' + 'x = 1\n' * 4,
+    '# one\n# two\n' + 'x = 1\n' * 20,
+    '    indented\n' * 3 + 'flat\n' * 7,
+    ' ' * 4,
+    '\r\n\r\n',
+    'x = 1\r\n    y = 2\r\n',
+    'line\x0cfeed\x0b\x1c\x1d\x1e\x85  ',
+]
+
+# Fragments for fuzzing: each one is a piece of some pattern, so random concatenations
+# produce near-misses and partial matches far more often than random text would
+FRAGMENTS = [
+    'try:', 'except', ':', '\n', '\r\n', ' ', '\t', '    ', '"""', "'", '"', "f'", 'f"', '{', '}',
+    '.format(', 'list(', 'dict(', '(', ')', 'def ', 'def\t', 'foo', 'fooBar', 'foo_bar', 'x', 'ab',
+    'import ', 'import', 'os', 'if __name__ == "__main__":', "__name__ == '__main__'", '# This function',
+    '# Initialize', '# Create', '# Set up', '#', 'AB', 'A', '_', '=', ' = ', '==', 'é', 'À', '\x0c', ' ',
+]
+
+def baseline_scan(code):
+    """The feature extraction CodeFeatureScanner replaced, kept verbatim apart from being one function"""
+    lines = code.split('\n')
+    conventions = {
+        'snake_case_functions': 0,
+        'camelCase_functions': 0,
+        'UPPERCASE_constants': 0,
+        'single_letter_vars': 0,
+        'descriptive_names': 0
+    }
+    function_pattern = re.compile(r'def\s+([a-zA-Z_][a-zA-Z0-9_]*)')
+    for line in lines:
+        for func_name in function_pattern.findall(line):
+            if '_' in func_name and func_name.islower():
+                conventions['snake_case_functions'] += 1
+            elif re.match(r'^[a-z]+[A-Z]', func_name):
+                conventions['camelCase_functions'] += 1
+            if len(func_name) > 3:
+                conventions['descriptive_names'] += 1
+        if re.search(r'[A-Z_]{2,}\s*=', line):
+            conventions['UPPERCASE_constants'] += 1
+        if re.search(r'\b[a-z]\s*=', line):
+            conventions['single_letter_vars'] += 1
+    
+    style = {
+        'avg_line_length': np.mean([len(line) for line in lines]) if lines else 0,
+        'empty_lines': len([line for line in lines if not line.strip()]),
+        'comments': len([line for line in lines if line.strip().startswith('#')]),
+        'docstrings': len(re.findall(r'""".*?"""', code, re.DOTALL)),
+        'indentation_style': 'spaces' if '    ' in code else 'tabs' if '\t' in code else 'mixed'
+    }
+    
+    ai_indicators = {'score': 0, 'indicators': [], 'confidence': 'low'}
+    ai_patterns = [
+        (r'# This function', 'Generic function comments'),
+        (r'# Initialize|# Create|# Set up', 'Verbose initialization comments'),
+        (r'def\s+\w+\(.*\):\s*""".*?"""', 'Detailed docstrings for simple functions'),
+        (r'if\s+__name__\s*==\s*[\'"]__main__[\'"]:', 'Standard main guard'),
+        (r'import\s+\w+\s*\n\s*import', 'Organized imports'),
+        (r'try:\s*\n.*?except.*?:', 'Exception handling patterns'),
+        (r'\.format\(|f[\'"].*?\{.*?\}', 'Modern string formatting'),
+        (r'list\(.*?\)|dict\(.*?\)', 'Explicit type conversions'),
+    ]
+    for pattern, description in ai_patterns:
+        if re.search(pattern, code, re.DOTALL | re.MULTILINE):
+            ai_indicators['score'] += 10
+            ai_indicators['indicators'].append(description)
+    
+    non_empty = [line for line in lines if line.strip()]
+    if non_empty:
+        indented_lines = [line for line in non_empty if line.startswith('    ')]
+        if len(indented_lines) > len(non_empty) * 0.3:
+            ai_indicators['score'] += 15
+            ai_indicators['indicators'].append('Consistent indentation pattern')
+        comment_ratio = len([line for line in non_empty if line.strip().startswith('#')]) / len(non_empty)
+        if 0.1 <= comment_ratio <= 0.3:
+            ai_indicators['score'] += 10
+            ai_indicators['indicators'].append('Optimal comment density')
+    
+    if ai_indicators['score'] >= 60:
+        ai_indicators['confidence'] = 'high'
+    elif ai_indicators['score'] >= 30:
+        ai_indicators['confidence'] = 'medium'
+    
+    return {
+        'lines_of_code': len(non_empty),
+        'naming_conventions': conventions,
+        'code_style': style,
+        'ai_indicators': ai_indicators
+    }
+
+def differences(expected, actual, path=''):
+    """Paths where two feature dicts disagree; float fields only need to agree to rounding"""
+    if isinstance(expected, dict):
+        found = []
+        for key in expected.keys() | actual.keys():
+            if key not in expected or key not in actual:
+                found.append(f'{path}.{key}: missing on one side')
+            else:
+                found.extend(differences(expected[key], actual[key], f'{path}.{key}'))
+        return found
+    if isinstance(expected, (float, np.floating)) or isinstance(actual, float):
+        return [] if math.isclose(expected, actual, rel_tol=1e-9, abs_tol=1e-9) else [f'{path}: {expected!r} != {actual!r}']
+    return [] if expected == actual else [f'{path}: {expected!r} != {actual!r}']
+
+def fuzzed_snippets(rng, count):
+    for _ in range(count):
+        yield ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(1, 40)))
+
+def stdlib_sources(limit):
+    paths = sorted(glob.glob(os.path.join(os.path.dirname(os.__file__), '**', '*.py'), recursive=True))
+    for path in paths[:limit]:
+        try:
+            with open(path, encoding='utf-8') as f:
+                yield f.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stdlib', type=int, default=500, help='standard library modules to compare')
+    parser.add_argument('--fuzz', type=int, default=5000, help='fuzzed snippets to compare')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+    
+    # Scanning needs no stores
+    for name in ('EMBEDDING_CACHE_PATH', 'FINGERPRINT_INDEX_PATH', 'SUBTREE_INDEX_PATH',
+                 'SUBMISSION_INDEX_PATH', 'JOB_STORE_PATH'):
+        os.environ[name] = ''
+    from main import CodeFeatureScanner
+    scanner = CodeFeatureScanner()
+    
+    documents, _ = build_corpus(originals=20, seed=args.seed)
+    sources = {
+        'adversarial': ADVERSARIAL,
+        'corpus': [document['code'] for document in documents],
+        'stdlib': list(stdlib_sources(args.stdlib)),
+        'fuzz': list(fuzzed_snippets(random.Random(args.seed), args.fuzz))
+    }
+    
+    failures = []
+    for source, codes in sources.items():
+        for number, code in enumerate(codes):
+            found = differences(baseline_scan(code), scanner.scan(code))
+            if found:
+                failures.append((source, number, code, found))
+        print(f'{source}: {len(codes)} inputs compared')
+    
+    for source, number, code, found in failures[:10]:
+        print(f'MISMATCH {source}[{number}] {code[:80]!r}')
+        for line in found:
+            print(f'    {line}')
+    print(f'{len(failures)} mismatches')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
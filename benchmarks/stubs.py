@@ -0,0 +1,62 @@
+"""Deterministic local stand-ins for the Cohere and Together.ai embedding APIs"""
+import re
+import time
+import types
+import zlib
+from collections import Counter
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'\w+|[^\s\w]')
+
+def stub_embedding(text, dim):
+    """Hashed bag-of-tokens vector, so similar code gets similar embeddings"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for token, count in Counter(TOKEN_PATTERN.findall(text)).items():
+        vector[zlib.crc32(token.encode('utf-8')) % dim] += count
+    return vector.tolist()
+
+class StubResponse:
+    status_code = 200
+    
+    def __init__(self, payload):
+        self.payload = payload
+    
+    def json(self):
+        return self.payload
+
+class StubProviders:
+    """Replaces the network round-trips of both providers with a fixed delay"""
+    
+    def __init__(self, latency=0.0, cohere_dim=1024, together_dim=768):
+        self.latency = latency
+        self.cohere_dim = cohere_dim
+        self.together_dim = together_dim
+        self.calls = Counter()
+    
+    def cohere_embed(self, texts, model=None, input_type=None, **kwargs):
+        self.calls['cohere'] += 1
+        time.sleep(self.latency)
+        return types.SimpleNamespace(embeddings=[stub_embedding(text, self.cohere_dim) for text in texts])
+    
+    def together_post(self, url, headers=None, json=None, **kwargs):
+        self.calls['together'] += 1
+        time.sleep(self.latency)
+        inputs = json['input'] if isinstance(json['input'], list) else [json['input']]
+        return StubResponse({'data': [
+            {'index': index, 'embedding': stub_embedding(text, self.together_dim)}
+            for index, text in enumerate(inputs)
+        ]})
+    
+    def install(self, main):
+        """Patch the app module; the real Cohere SDK is still imported and built on first use"""
+        real_get_cohere_client = main.get_cohere_client
+        
+        def get_cohere_client():
+            client = real_get_cohere_client()
+            client.embed = self.cohere_embed
+            return client
+        
+        main.get_cohere_client = get_cohere_client
+        main.http_session.post = self.together_post
+        return self
@@ -165,7 +165,7 @@ const ResultsPanel = ({ results, isLoading, darkMode }) => {
 
         {/* Individual Model Scores */}
         <div className="space-y-4 mb-6">
-          {Object.entries(results).filter(([key]) => key !== 'FinalVerdict').map(([model, score], index) => (
+          {Object.entries(results).filter(([key, score]) => key !== 'FinalVerdict' && typeof score === 'number').map(([model, score], index) => (
             <motion.div
               key={model}
               className="space-y-2"
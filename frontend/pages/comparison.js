@@ -1,4 +1,4 @@
-import { useState } from 'react'
+import { useRef, useState } from 'react'
 import Head from 'next/head'
 import { motion } from 'framer-motion'
 import CodeEditor from '../components/CodeEditor'
@@ -11,6 +11,8 @@ export default function Comparison({ darkMode, toggleDarkMode }) {
   const [detailedResults, setDetailedResults] = useState(null)
   const [isLoading, setIsLoading] = useState(false)
   const [error, setError] = useState(null)
+  // Last response and its ETag, so re-running the same comparison can be revalidated with a 304
+  const lastResponse = useRef(null)
 
   const handleDetailedCompare = async () => {
     if (!code1.trim() || !code2.trim()) {
@@ -22,17 +24,29 @@ export default function Comparison({ darkMode, toggleDarkMode }) {
     setError(null)
     setDetailedResults(null)
 
-    try {        const response = await fetch('/api/detailed-check', {
+    try {
+      const body = JSON.stringify({
+        code1: code1.trim(),
+        code2: code2.trim(),
+      })
+      const headers = {
+        'Content-Type': 'application/json',
+      }
+      if (lastResponse.current && lastResponse.current.body === body) {
+        headers['If-None-Match'] = lastResponse.current.etag
+      }
+
+      const response = await fetch('/api/detailed-check', {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          code1: code1.trim(),
-          code2: code2.trim(),
-        }),
+        headers,
+        body,
       })
 
+      if (response.status === 304) {
+        setDetailedResults(lastResponse.current.data)
+        return
+      }
+
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`)
       }
@@ -43,6 +57,8 @@ export default function Comparison({ darkMode, toggleDarkMode }) {
         throw new Error(data.error)
       }
 
+      const etag = response.headers.get('ETag')
+      lastResponse.current = etag ? { body, etag, data } : null
       setDetailedResults(data)
     } catch (err) {
       console.error('Detailed comparison error:', err)
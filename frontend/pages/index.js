@@ -1,4 +1,4 @@
-import { useState } from 'react'
+import { useRef, useState } from 'react'
 import Head from 'next/head'
 import { motion } from 'framer-motion'
 import Link from 'next/link'
@@ -12,6 +12,8 @@ export default function Home({ darkMode, toggleDarkMode }) {
   const [results, setResults] = useState(null)
   const [isLoading, setIsLoading] = useState(false)
   const [error, setError] = useState(null)
+  // Last response and its ETag, so re-running the same comparison can be revalidated with a 304
+  const lastResponse = useRef(null)
 
   const handleCompare = async () => {
     if (!code1.trim() || !code2.trim()) {
@@ -24,17 +26,28 @@ export default function Home({ darkMode, toggleDarkMode }) {
     setResults(null)
 
     try {
+      const body = JSON.stringify({
+        code1: code1.trim(),
+        code2: code2.trim(),
+      })
+      const headers = {
+        'Content-Type': 'application/json',
+      }
+      if (lastResponse.current && lastResponse.current.body === body) {
+        headers['If-None-Match'] = lastResponse.current.etag
+      }
+
       const response = await fetch('/api/check', {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          code1: code1.trim(),
-          code2: code2.trim(),
-        }),
+        headers,
+        body,
       })
 
+      if (response.status === 304) {
+        setResults(lastResponse.current.data)
+        return
+      }
+
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`)
       }
@@ -45,6 +58,8 @@ export default function Home({ darkMode, toggleDarkMode }) {
         throw new Error(data.error)
       }
 
+      const etag = response.headers.get('ETag')
+      lastResponse.current = etag ? { body, etag, data } : null
       setResults(data)
     } catch (err) {
       console.error('Comparison error:', err)
@@ -0,0 +1,44 @@
+# Gunicorn configuration for production serving
+# Usage: gunicorn -c gunicorn.conf.py main:app
+import multiprocessing
+import os
+import tempfile
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', 5000)}"
+
+# Pre-forked workers, each with a few threads for concurrent provider-bound requests
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Each worker gets its share of the CPUs for /batch-analyze process pools, so workers x pool
+# processes stays near the CPU count; must be set before the app is imported
+os.environ.setdefault('ANALYSIS_WORKERS', str(max(1, multiprocessing.cpu_count() // workers)))
+
+# Import the app once in the master so warm state (pinned AI reference matrix,
+# loaded indexes) is shared copy-on-write by every worker. Caches, indexes and
+# jobs are backed by SQLite files that all workers read and write.
+preload_app = True
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Workers write Prometheus metrics to files here so /metrics reports all of them;
+# must be set before the app (and prometheus_client) is imported
+if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='prometheus-')
+
+def post_fork(server, worker):
+    # Job threads must start in the worker: the preloading master never runs jobs. Every
+    # worker heartbeats its own jobs; one at a time, via a lease in the job store, requeues
+    # jobs left behind by a worker that died or a previous deployment
+    from main import job_queue
+    job_queue.start()
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+accesslog = '-'
+errorlog = '-'
@@ -1,166 +1,1934 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, has_request_context, request, jsonify, send_from_directory, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import os
+import math
+import orjson
 import requests
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-import cohere
 from dotenv import load_dotenv
 import json
 import re
 import ast
 import keyword
-from collections import Counter
+import builtins
+import hashlib
+import io
+import tarfile
+import tempfile
+import textwrap
+import tokenize
+import zipfile
+import zlib
+import sqlite3
+import threading
+import time
+import random
+import uuid
+import multiprocessing
+import signal
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter as MetricCounter, Histogram, generate_latest, multiprocess
+)
 
 # Load environment variables
 load_dotenv()
 
+def json_default(obj):
+    """Encode the few types orjson does not handle natively"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+def dumps_json(obj, sort_keys=False):
+    """Serialize in one native pass, NumPy scalars and arrays included, without converting the tree first"""
+    return orjson.dumps(obj, default=json_default, option=JSON_OPTIONS | (orjson.OPT_SORT_KEYS if sort_keys else 0))
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON encoded by orjson straight to bytes; keys stay sorted like Flask's default"""
+    
+    def dumps(self, obj, **kwargs):
+        return dumps_json(obj, kwargs.get('sort_keys', self.sort_keys)).decode('utf-8')
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_json(obj, self.sort_keys), mimetype=self.mimetype)
+
 app = Flask(__name__)
-CORS(app)
+app.json = FastJSONProvider(app)
+CORS(app, expose_headers=['ETag', 'Server-Timing'])
+
+COHERE_EMBED_MODEL = 'embed-english-v3.0'
+TOGETHER_EMBED_MODEL = 'BAAI/bge-base-en-v1.5'
+
+def connect_sqlite(path):
+    """SQLite connection usable from request threads and shared by several worker processes"""
+    connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    if path != ':memory:':
+        # WAL lets workers read while another one writes
+        connection.execute('PRAGMA journal_mode=WAL')
+    return connection
+
+# Analysis pool processes are started fresh and import this module only to run CPU-bound analysis
+# (as __mp_main__ when the server was started as a script)
+SERVING_PROCESS = multiprocessing.parent_process() is None and __name__ != '__mp_main__'
+
+def store_path(name, default):
+    """SQLite path of a shared store from the environment; analysis pool processes open no stores"""
+    return (os.getenv(name, default) or None) if SERVING_PROCESS else None
+
+# Prometheus metrics; under gunicorn, PROMETHEUS_MULTIPROC_DIR makes them aggregate across workers
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_SECONDS = Histogram(
+    'plagiarism_request_seconds', 'Request latency by route', ['route'], buckets=LATENCY_BUCKETS
+)
+REQUESTS_TOTAL = MetricCounter(
+    'plagiarism_requests_total', 'Requests by route and status code', ['route', 'status']
+)
+REQUEST_INPUT_BYTES = Histogram(
+    'plagiarism_request_input_bytes', 'Request body size by route', ['route'],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+)
+STAGE_SECONDS = Histogram(
+    'plagiarism_stage_seconds', 'Time spent in each processing stage', ['stage'], buckets=LATENCY_BUCKETS
+)
+PROVIDER_SECONDS = Histogram(
+    'plagiarism_provider_seconds', 'Latency of individual provider call attempts', ['provider'],
+    buckets=LATENCY_BUCKETS
+)
+PROVIDER_ERRORS = MetricCounter(
+    'plagiarism_provider_errors_total', 'Failed provider call attempts', ['provider', 'kind']
+)
+PROVIDER_TIMEOUTS = MetricCounter(
+    'plagiarism_provider_timeouts_total', 'Comparisons that gave up waiting on a provider', ['provider']
+)
+EMBEDDING_CACHE_LOOKUPS = MetricCounter(
+    'plagiarism_embedding_cache_lookups_total', 'Embedding cache lookups by outcome', ['result']
+)
+RESULT_CACHE_LOOKUPS = MetricCounter(
+    'plagiarism_result_cache_lookups_total', 'Comparison result cache lookups by kind and outcome', ['kind', 'result']
+)
+REGISTRATIONS_DROPPED = MetricCounter(
+    'plagiarism_registrations_dropped_total', 'Background index registrations dropped because the queue was full'
+)
+
+@contextmanager
+def timed_stage(name):
+    """Time a block into the stage histogram and the current request's Server-Timing breakdown"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(name).observe(elapsed)
+        if has_request_context():
+            timings = g.setdefault('stage_timings', {})
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+class EmbeddingCache:
+    """Two-tier embedding cache: in-process LRU backed by a SQLite store"""
+    
+    def __init__(self, max_size=2048, ttl=86400, db_path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.stats_counter = Counter()
+        
+        if db_path:
+            try:
+                self._db = connect_sqlite(db_path)
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS embeddings ('
+                    'key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)'
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Embedding cache disk tier disabled: {e}")
+                self._db = None
+    
+    @staticmethod
+    def make_key(provider, model, code):
+        """Build a content-addressed key from provider, model and normalized code"""
+        normalized = re.sub(r'\s+', ' ', code.strip())
+        digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+        return f'{provider}:{model}:{digest}'
+    
+    def get(self, provider, model, code):
+        """Return a cached embedding or None, promoting disk hits into memory"""
+        key = self.make_key(provider, model, code)
+        now = time.time()
+        
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                embedding, stored_at = entry
+                if not self.ttl or now - stored_at < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.stats_counter['memory_hits'] += 1
+                    EMBEDDING_CACHE_LOOKUPS.labels('memory_hit').inc()
+                    return embedding
+                del self._memory[key]
+            
+            if self._db is not None:
+                try:
+                    row = self._db.execute(
+                        'SELECT vector FROM embeddings WHERE key = ?', (key,)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    print(f"Embedding cache read error: {e}")
+                    row = None
+                if row is not None:
+                    embedding = np.frombuffer(row[0], dtype=np.float32).tolist()
+                    self._remember(key, embedding, now)
+                    self.stats_counter['disk_hits'] += 1
+                    EMBEDDING_CACHE_LOOKUPS.labels('disk_hit').inc()
+                    return embedding
+            
+            self.stats_counter['misses'] += 1
+            EMBEDDING_CACHE_LOOKUPS.labels('miss').inc()
+            return None
+    
+    def set(self, provider, model, code, embedding):
+        """Store an embedding in both tiers"""
+        key = self.make_key(provider, model, code)
+        now = time.time()
+        
+        with self._lock:
+            self._remember(key, embedding, now)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)',
+                        (key, np.asarray(embedding, dtype=np.float32).tobytes(), now)
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"Embedding cache write error: {e}")
+    
+    def reinitialize_after_fork(self):
+        """Fresh lock and connection in a forked worker; the disk tier is the state shared between workers"""
+        self._lock = threading.Lock()
+        if self._db is not None:
+            self._db = connect_sqlite(self.db_path)
+    
+    def _remember(self, key, embedding, stored_at):
+        """Insert into the memory tier and evict least recently used entries"""
+        self._memory[key] = (embedding, stored_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+            self.stats_counter['evictions'] += 1
+    
+    def stats(self):
+        """Hit/miss counters for monitoring"""
+        with self._lock:
+            hits = self.stats_counter['memory_hits'] + self.stats_counter['disk_hits']
+            lookups = hits + self.stats_counter['misses']
+            return {
+                'memory_hits': self.stats_counter['memory_hits'],
+                'disk_hits': self.stats_counter['disk_hits'],
+                'misses': self.stats_counter['misses'],
+                'evictions': self.stats_counter['evictions'],
+                'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'disk_enabled': self._db is not None
+            }
+
+embedding_cache = EmbeddingCache(
+    max_size=int(os.getenv('EMBEDDING_CACHE_SIZE', 2048)),
+    ttl=float(os.getenv('EMBEDDING_CACHE_TTL', 86400)),
+    db_path=store_path('EMBEDDING_CACHE_PATH', 'embedding_cache.db')
+)
+
+def normalize_rows(vectors):
+    """Stack vectors into a float32 matrix with unit-length rows"""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+# Token kinds dropped before fingerprinting: layout and comments carry no logic
+SKIPPED_TOKEN_TYPES = {
+    tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT,
+    tokenize.DEDENT, tokenize.ENCODING, tokenize.ENDMARKER
+}
+PRESERVED_NAMES = set(keyword.kwlist) | set(dir(builtins))
+FALLBACK_TOKEN_PATTERN = re.compile(r'[A-Za-z_]\w*|\d[\w.]*|"[^"\n]*"|\'[^\'\n]*\'|\S')
+
+def normalize_code_tokens(code):
+    """Tokenize code with identifiers and literals normalized; returns (tokens, line numbers)"""
+    tokens, lines = [], []
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(code).readline):
+            if tok.type in SKIPPED_TOKEN_TYPES:
+                continue
+            if tok.type == tokenize.NAME:
+                tokens.append(tok.string if tok.string in PRESERVED_NAMES else 'V')
+            elif tok.type == tokenize.NUMBER:
+                tokens.append('N')
+            elif tok.type == tokenize.STRING:
+                tokens.append('S')
+            else:
+                tokens.append(tok.string)
+            lines.append(tok.start[0])
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        # Not valid Python (or another language): fall back to a regex lexer
+        tokens, lines = [], []
+        for line_number, line in enumerate(code.split('\n'), 1):
+            for word in FALLBACK_TOKEN_PATTERN.findall(line):
+                if word[0] in '"\'':
+                    tokens.append('S')
+                elif word[0].isdigit():
+                    tokens.append('N')
+                elif word[0].isalpha() or word[0] == '_':
+                    tokens.append(word if word in PRESERVED_NAMES else 'V')
+                else:
+                    tokens.append(word)
+                lines.append(line_number)
+    return tokens, lines
+
+class WinnowingFingerprinter:
+    """MOSS-style k-gram winnowing over normalized token streams"""
+    
+    HASH_BASE = np.uint64(1000003)
+    HASH_MASK = np.uint64(0x7FFFFFFFFFFFFFFF)  # keep hashes storable as signed SQLite integers
+    
+    def __init__(self, k=5, window=4):
+        self.k = k
+        self.window = window
+        self._token_hashes = {}
+    
+    def _hash_tokens(self, tokens):
+        token_hashes = self._token_hashes
+        values = []
+        for token in tokens:
+            value = token_hashes.get(token)
+            if value is None:
+                value = token_hashes.setdefault(token, zlib.crc32(token.encode('utf-8')))
+            values.append(value)
+        return np.asarray(values, dtype=np.uint64)
+    
+    def gram_hashes(self, code):
+        """Hash every normalized token k-gram; returns (hashes, line number of each k-gram)"""
+        tokens, lines = normalize_code_tokens(code)
+        if len(tokens) < self.k:
+            return np.zeros(0, dtype=np.uint64), []
+        
+        # Polynomial rolling hash of every k-gram, vectorized over positions (wraps mod 2**64)
+        token_hashes = self._hash_tokens(tokens)
+        count = len(tokens) - self.k + 1
+        gram_hashes = np.zeros(count, dtype=np.uint64)
+        for offset in range(self.k):
+            gram_hashes = gram_hashes * self.HASH_BASE + token_hashes[offset:offset + count]
+        return gram_hashes & self.HASH_MASK, lines[:count]
+    
+    def fingerprint(self, code):
+        """Return {fingerprint hash: first line number} for the winnowed k-gram hashes"""
+        gram_hashes, lines = self.gram_hashes(code)
+        count = len(gram_hashes)
+        if not count:
+            return {}
+        
+        # Winnowing: keep the minimum hash of every window of consecutive k-grams
+        if count > self.window:
+            windows = np.lib.stride_tricks.sliding_window_view(gram_hashes, self.window)
+            positions = np.unique(windows.argmin(axis=1) + np.arange(len(windows)))
+        else:
+            positions = np.array([int(gram_hashes.argmin())])
+        
+        fingerprints = {}
+        for position in positions.tolist():
+            fingerprints.setdefault(int(gram_hashes[position]), lines[position])
+        return fingerprints
+    
+    @staticmethod
+    def similarity(fingerprints1, fingerprints2):
+        """Jaccard overlap of two fingerprint sets, as a percentage"""
+        if not fingerprints1 or not fingerprints2:
+            return 0.0
+        shared = len(fingerprints1.keys() & fingerprints2.keys())
+        return 100.0 * shared / (len(fingerprints1) + len(fingerprints2) - shared)
+
+class FingerprintIndex:
+    """Inverted index from fingerprint hash (winnowing k-gram or AST subtree) to the submissions containing it"""
+    
+    # Bound parameters per statement, under SQLite's historical limit of 999
+    MAX_PARAMS = 900
+    
+    def __init__(self, db_path=None, version=None):
+        self.db_path = db_path
+        self.version = version
+        self._lock = threading.Lock()
+        # Postings are read through SQLite's (hash, submission_id) key at lookup time, so worker
+        # processes share the store's pages instead of each holding its own copy of the index
+        try:
+            self._db = self._connect(db_path or ':memory:', version)
+        except sqlite3.Error as e:
+            print(f"Fingerprint index persistence disabled: {e}")
+            self.db_path = None
+            self._db = self._connect(':memory:', version)
+    
+    @staticmethod
+    def _connect(path, version=None):
+        db = connect_sqlite(path)
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprints ('
+            'hash INTEGER NOT NULL, submission_id TEXT NOT NULL, PRIMARY KEY (hash, submission_id))'
+        )
+        db.execute('CREATE TABLE IF NOT EXISTS submission_sizes (submission_id TEXT PRIMARY KEY, size INTEGER NOT NULL)')
+        if db.execute(
+            'SELECT NOT EXISTS (SELECT 1 FROM submission_sizes) AND EXISTS (SELECT 1 FROM fingerprints)'
+        ).fetchone()[0]:
+            # Stores written before sizes were kept alongside the postings
+            db.execute('INSERT INTO submission_sizes SELECT submission_id, COUNT(*) FROM fingerprints GROUP BY submission_id')
+        if version is not None:
+            # Hashes from another version of the hasher would never match new ones
+            db.execute('CREATE TABLE IF NOT EXISTS index_meta (key TEXT PRIMARY KEY, value TEXT)')
+            stored = db.execute("SELECT value FROM index_meta WHERE key = 'version'").fetchone()
+            if stored is None or stored[0] != str(version):
+                db.execute('DELETE FROM fingerprints')
+                db.execute('DELETE FROM submission_sizes')
+                db.execute("INSERT OR REPLACE INTO index_meta (key, value) VALUES ('version', ?)", (str(version),))
+        db.commit()
+        return db
+    
+    def reinitialize_after_fork(self):
+        self._lock = threading.Lock()
+        if self.db_path:
+            self._db = connect_sqlite(self.db_path)
+    
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM submission_sizes').fetchone()[0]
+    
+    def _select_in(self, sql, values):
+        """Rows of a query with one IN (...) list, run in chunks of at most MAX_PARAMS values"""
+        for start in range(0, len(values), self.MAX_PARAMS):
+            chunk = values[start:start + self.MAX_PARAMS]
+            yield from self._db.execute(sql.format(', '.join('?' * len(chunk))), chunk)
+    
+    def add(self, submission_id, fingerprints):
+        """Index a submission's fingerprints; returns False if it is already indexed"""
+        if not fingerprints:
+            return False
+        with self._lock:
+            try:
+                if not self._db.execute(
+                    'INSERT OR IGNORE INTO submission_sizes (submission_id, size) VALUES (?, ?)',
+                    (submission_id, len(fingerprints))
+                ).rowcount:
+                    self._db.commit()
+                    return False
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO fingerprints (hash, submission_id) VALUES (?, ?)',
+                    [(fingerprint, submission_id) for fingerprint in fingerprints]
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Fingerprint index write error: {e}")
+                self._db.rollback()
+                return False
+        return True
+    
+    def lookup(self, fingerprints, k=10, exclude=None):
+        """Rank indexed submissions by fingerprint overlap without touching unrelated ones"""
+        fingerprints = list(fingerprints)
+        shared = Counter()
+        with self._lock:
+            try:
+                shared.update(submission_id for (submission_id,) in self._select_in(
+                    'SELECT submission_id FROM fingerprints WHERE hash IN ({})', fingerprints
+                ))
+                sizes = dict(self._select_in(
+                    'SELECT submission_id, size FROM submission_sizes WHERE submission_id IN ({})', list(shared)
+                ))
+            except sqlite3.Error as e:
+                print(f"Fingerprint index read error: {e}")
+                return []
+        
+        scored = []
+        for submission_id, overlap in shared.items():
+            if submission_id == exclude:
+                continue
+            union = len(fingerprints) + sizes[submission_id] - overlap
+            scored.append({
+                'id': submission_id,
+                'score': round(100.0 * overlap / union, 2),
+                'shared_fingerprints': overlap
+            })
+        scored.sort(key=lambda match: match['score'], reverse=True)
+        return scored[:k]
+
+class MinHashLSH:
+    """MinHash signatures over token shingles, banded into LSH buckets for candidate generation"""
+    
+    def __init__(self, num_perm=128, bands=32, seed=1):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.default_rng(seed)
+        # (shingle ^ seed) * odd multiplier is a bijection mod 2**64, one per permutation
+        self.seeds = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+        self.multipliers = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64) | np.uint64(1)
+    
+    def signatures(self, shingle_sets, chunk=16):
+        """(N, num_perm) signature matrix; rows of empty sets stay at the max value"""
+        signatures = np.full((len(shingle_sets), self.num_perm), np.iinfo(np.uint64).max, dtype=np.uint64)
+        present = [i for i, shingles in enumerate(shingle_sets) if len(shingles)]
+        if not present:
+            return signatures
+        
+        flat = np.concatenate([shingle_sets[i] for i in present])
+        offsets = np.cumsum([0] + [len(shingle_sets[i]) for i in present[:-1]])
+        
+        # All submissions at once: permute the flat shingle array, then min-reduce per segment
+        for start in range(0, self.num_perm, chunk):
+            seeds = self.seeds[start:start + chunk, None]
+            multipliers = self.multipliers[start:start + chunk, None]
+            permuted = (flat[None, :] ^ seeds) * multipliers
+            signatures[present, start:start + chunk] = np.minimum.reduceat(permuted, offsets, axis=1).T
+        return signatures
+    
+    def candidate_pairs(self, signatures, min_jaccard=0.0, max_bucket_size=1000):
+        """Pairs sharing at least one band bucket, filtered by estimated Jaccard similarity"""
+        count = len(signatures)
+        present = np.nonzero(signatures[:, 0] != np.iinfo(np.uint64).max)[0]
+        pair_codes = []
+        
+        for band in range(self.bands):
+            block = np.ascontiguousarray(signatures[present, band * self.rows:(band + 1) * self.rows])
+            keys = block.view(np.dtype((np.void, block.dtype.itemsize * self.rows))).ravel()
+            _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+            
+            # Oversized buckets are shared boilerplate (templates, starter code), not evidence
+            shared = np.nonzero((counts > 1) & (counts <= max_bucket_size))[0]
+            if not len(shared):
+                continue
+            
+            order = np.argsort(inverse.ravel(), kind='stable')
+            ends = np.cumsum(counts)
+            for bucket in shared:
+                members = present[order[ends[bucket] - counts[bucket]:ends[bucket]]]
+                a, b = np.triu_indices(len(members), 1)
+                pair_codes.append(members[a] * count + members[b])
+        
+        if not pair_codes:
+            return []
+        
+        # Each pair is encoded as i * N + j (i < j) so duplicates across bands collapse in one pass
+        pair_codes = np.unique(np.concatenate(pair_codes))
+        results = []
+        for start in range(0, len(pair_codes), 65536):
+            chunk = pair_codes[start:start + 65536]
+            first, second = chunk // count, chunk % count
+            estimates = (signatures[first] == signatures[second]).mean(axis=1)
+            keep = estimates >= min_jaccard
+            results.extend(zip(first[keep].tolist(), second[keep].tolist(), estimates[keep].tolist()))
+        return results
+
+class SubtreeHasher:
+    """Merkle hashes of canonical AST subtrees, invariant to renaming, literals and docstrings"""
+    
+    # Bump when the canonical form changes; persisted subtree indexes are cleared on a mismatch
+    VERSION = 2
+    IGNORED_FIELDS = {'ctx', 'kind', 'type_comment', 'type_ignores'}
+    # Every field holding a user-chosen identifier, including attribute and match-pattern names
+    RENAMED_FIELDS = {'id', 'arg', 'attr', 'name', 'asname', 'names', 'vararg', 'kwarg', 'kwd_attrs', 'rest'}
+    HASH_MASK = 0x7FFFFFFFFFFFFFFF
+    
+    def __init__(self, min_size=10):
+        self.min_size = min_size
+    
+    def hashes(self, tree):
+        """Return {subtree hash: line number} for every subtree of at least min_size nodes"""
+        found = {}
+        try:
+            self._visit(tree, found)
+        except RecursionError:
+            pass
+        return found
+    
+    def _visit(self, node, found):
+        parts = [type(node).__name__]
+        size = 1
+        
+        for field, value in ast.iter_fields(node):
+            if field in self.IGNORED_FIELDS:
+                continue
+            if isinstance(value, list):
+                if field in ('body', 'orelse', 'finalbody'):
+                    value = [item for item in value if not self._is_docstring(item)]
+                items = []
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        child_hash, child_size = self._visit(item, found)
+                        items.append(child_hash)
+                        size += child_size
+                    else:
+                        items.append(self._leaf(node, field, item))
+                parts.append(f"{field}=[{','.join(items)}]")
+            elif isinstance(value, ast.AST):
+                child_hash, child_size = self._visit(value, found)
+                parts.append(f'{field}={child_hash}')
+                size += child_size
+            else:
+                parts.append(f'{field}={self._leaf(node, field, value)}')
+        
+        digest = int.from_bytes(
+            hashlib.blake2b('|'.join(parts).encode('utf-8'), digest_size=8).digest(), 'big'
+        ) & self.HASH_MASK
+        if size >= self.min_size:
+            found.setdefault(digest, getattr(node, 'lineno', 1))
+        return format(digest, 'x'), size
+    
+    @staticmethod
+    def _is_docstring(node):
+        return isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+    
+    def _leaf(self, node, field, value):
+        if value is None:
+            return '-'
+        if isinstance(node, ast.Constant) and field == 'value':
+            return type(value).__name__
+        # Imported module names stay; the local name an import is bound to (asname) is renamed
+        if field in self.RENAMED_FIELDS and not (isinstance(node, ast.alias) and field == 'name'):
+            return value if value in PRESERVED_NAMES else 'V'
+        return str(value)
+    
+    @staticmethod
+    def similarity(hashes1, hashes2):
+        """Jaccard overlap of two subtree hash sets, as a percentage"""
+        if not hashes1 or not hashes2:
+            return 0.0
+        shared = len(hashes1.keys() & hashes2.keys())
+        return 100.0 * shared / (len(hashes1) + len(hashes2) - shared)
+
+class CodeFeatureScanner:
+    """Naming, style and AI-pattern features in linear time, from one pass over the lines"""
+    
+    # Each AI pattern is one or more alternative step sequences, searched forward through the
+    # code: a sequence matches when its steps occur in order, which is what the original DOTALL
+    # regexes with `.*?` between the parts expressed. Taking the earliest match of each step
+    # never loses a later one, so no step is ever retried. Steps have no overlapping
+    # quantifiers (`[^\S\n]*\n` instead of `\s*\n`), so each search is linear as well.
+    AI_PATTERNS = [
+        ('Generic function comments', [
+            [r'# This function']
+        ]),
+        ('Verbose initialization comments', [
+            [r'# Initialize|# Create|# Set up']
+        ]),
+        ('Detailed docstrings for simple functions', [
+            [r'def\s+\w+\(', r'\):\s*"""', r'"""']
+        ]),
+        ('Standard main guard', [
+            [r'if\s+__name__\s*==\s*[\'"]__main__[\'"]:']
+        ]),
+        ('Organized imports', [
+            [r'import\s+\w+[^\S\n]*\n\s*import']
+        ]),
+        ('Exception handling patterns', [
+            [r'try:[^\S\n]*\n', r'except', r':']
+        ]),
+        ('Modern string formatting', [
+            [r'\.format\('],
+            [r'f[\'"]', r'\{', r'\}']
+        ]),
+        ('Explicit type conversions', [
+            [r'list\(|dict\(', r'\)']
+        ]),
+    ]
+    
+    FUNCTION_NAME = re.compile(r'def\s+([a-zA-Z_][a-zA-Z0-9_]*)')
+    CAMEL_CASE = re.compile(r'[a-z]+[A-Z]')
+    # The lookbehind anchors the run at its start, so a long run of capitals is scanned once
+    CONSTANT_ASSIGNMENT = re.compile(r'(?<![A-Z_])[A-Z_]{2,}\s*=')
+    SINGLE_LETTER_ASSIGNMENT = re.compile(r'\b[a-z]\s*=')
+    
+    def __init__(self):
+        self.patterns = [
+            (description, [[re.compile(step) for step in steps] for steps in alternatives])
+            for description, alternatives in self.AI_PATTERNS
+        ]
+    
+    @staticmethod
+    def _matches_in_order(code, steps):
+        position = 0
+        for step in steps:
+            match = step.search(code, position)
+            if match is None:
+                return False
+            position = match.end()
+        return True
+    
+    def scan(self, code):
+        """Return lines_of_code, naming_conventions, code_style and ai_indicators for the code"""
+        lines = code.split('\n')
+        naming = {
+            'snake_case_functions': 0,
+            'camelCase_functions': 0,
+            'UPPERCASE_constants': 0,
+            'single_letter_vars': 0,
+            'descriptive_names': 0
+        }
+        non_empty = 0
+        comments = 0
+        indented = 0
+        
+        for line in lines:
+            stripped = line.strip()
+            if not stripped:
+                continue
+            non_empty += 1
+            if stripped[0] == '#':
+                comments += 1
+            if line.startswith('    '):
+                indented += 1
+            
+            if 'def' in line:
+                for name in self.FUNCTION_NAME.findall(line):
+                    if '_' in name and name.islower():
+                        naming['snake_case_functions'] += 1
+                    elif self.CAMEL_CASE.match(name):
+                        naming['camelCase_functions'] += 1
+                    if len(name) > 3:
+                        naming['descriptive_names'] += 1
+            if '=' in line:
+                if self.CONSTANT_ASSIGNMENT.search(line):
+                    naming['UPPERCASE_constants'] += 1
+                if self.SINGLE_LETTER_ASSIGNMENT.search(line):
+                    naming['single_letter_vars'] += 1
+        
+        style = {
+            # Every character except the newlines, spread over the lines
+            'avg_line_length': (len(code) - len(lines) + 1) / len(lines),
+            'empty_lines': len(lines) - non_empty,
+            'comments': comments,
+            # Non-overlapping """...""" pairs
+            'docstrings': code.count('"""') // 2,
+            'indentation_style': 'spaces' if '    ' in code else 'tabs' if '\t' in code else 'mixed'
+        }
+        
+        ai_indicators = {'score': 0, 'indicators': [], 'confidence': 'low'}
+        for description, alternatives in self.patterns:
+            if any(self._matches_in_order(code, steps) for steps in alternatives):
+                ai_indicators['score'] += 10
+                ai_indicators['indicators'].append(description)
+        
+        if non_empty:
+            # Check for overly perfect structure
+            if indented > non_empty * 0.3:
+                ai_indicators['score'] += 15
+                ai_indicators['indicators'].append('Consistent indentation pattern')
+            
+            comment_ratio = comments / non_empty
+            if 0.1 <= comment_ratio <= 0.3:
+                ai_indicators['score'] += 10
+                ai_indicators['indicators'].append('Optimal comment density')
+        
+        if ai_indicators['score'] >= 60:
+            ai_indicators['confidence'] = 'high'
+        elif ai_indicators['score'] >= 30:
+            ai_indicators['confidence'] = 'medium'
+        
+        return {
+            'lines_of_code': non_empty,
+            'naming_conventions': naming,
+            'code_style': style,
+            'ai_indicators': ai_indicators
+        }
+
+class LocalEmbedder:
+    """Offline embeddings: hashed n-grams of normalized code tokens as sparse unit-length rows"""
+    
+    # One regex pass instead of the tokenize module: comments, (prefixed, triple-quoted) strings, names, numbers, operators
+    TOKEN_PATTERN = re.compile(
+        r'#[^\n]*'
+        r'|[rbuRBUfF]{0,2}(?:"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|"(?:\\[\s\S]|[^"\\\n])*"|\'(?:\\[\s\S]|[^\'\\\n])*\')'
+        r'|[A-Za-z_]\w*|\.?\d(?:[\w.]|(?<=[eE])[-+])*|\.\.\.|\*\*=?|//=?|->|<<=?|>>=?|:=|[-+*/%&|^@<>=!]=|\S'
+    )
+    
+    def __init__(self, n_features=2 ** 18, max_ngram=3):
+        self.n_features = n_features
+        self.max_ngram = max_ngram
+        self._vectorizer = None
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def _tokens(cls, code):
+        """Regex approximation of normalize_code_tokens (V/N/S placeholders), about four times faster"""
+        tokens = []
+        for token in cls.TOKEN_PATTERN.findall(code):
+            first = token[0]
+            if first == '#' or first == '\\':
+                continue
+            if token[-1] in '"\'' and len(token) > 1:
+                tokens.append('S')
+            elif first.isdigit() or first == '.' and len(token) > 1 and token != '...':
+                tokens.append('N')
+            elif first.isalpha() or first == '_':
+                tokens.append(token if token in PRESERVED_NAMES else 'V')
+            else:
+                tokens.append(token)
+        return tokens
+    
+    def _get_vectorizer(self):
+        # scikit-learn is only imported once a local embedding is actually requested
+        if self._vectorizer is None:
+            with self._lock:
+                if self._vectorizer is None:
+                    from sklearn.feature_extraction.text import HashingVectorizer
+                    self._vectorizer = HashingVectorizer(
+                        tokenizer=self._tokens,
+                        preprocessor=None,
+                        lowercase=False,
+                        token_pattern=None,
+                        ngram_range=(1, self.max_ngram),
+                        n_features=self.n_features,
+                        alternate_sign=False,
+                        norm=None,
+                        dtype=np.float32
+                    )
+        return self._vectorizer
+    
+    def embed(self, codes, idf=False):
+        """Sparse CSR matrix of unit rows; idf=True down-weights n-grams common across the given corpus"""
+        from sklearn.feature_extraction.text import TfidfTransformer
+        counts = self._get_vectorizer().transform(codes)
+        # Hashing needs no fitted vocabulary, so only the IDF weights depend on the corpus
+        return TfidfTransformer(sublinear_tf=True, use_idf=idf).fit_transform(counts)
+    
+    def similarity(self, code1, code2):
+        """Cosine similarity of two snippets, as a percentage"""
+        vectors = self.embed([code1, code2])
+        return 100.0 * row_cosine(vectors[0], vectors[1])
+
+def row_cosine(vector1, vector2):
+    """Dot product of two unit-length rows, dense or sparse"""
+    if hasattr(vector1, 'multiply'):
+        return float(vector1.multiply(vector2).sum())
+    return float(vector1 @ vector2)
+
+fingerprinter = WinnowingFingerprinter(
+    k=int(os.getenv('WINNOW_K', 5)),
+    window=int(os.getenv('WINNOW_WINDOW', 4))
+)
+minhash_lsh = MinHashLSH(
+    num_perm=int(os.getenv('MINHASH_PERMUTATIONS', 128)),
+    bands=int(os.getenv('LSH_BANDS', 32))
+)
+fingerprint_index = FingerprintIndex(store_path('FINGERPRINT_INDEX_PATH', 'fingerprint_index.db'))
+subtree_hasher = SubtreeHasher(min_size=int(os.getenv('SUBTREE_MIN_SIZE', 10)))
+feature_scanner = CodeFeatureScanner()
+local_embedder = LocalEmbedder(
+    n_features=int(os.getenv('LOCAL_EMBED_FEATURES', 2 ** 18)),
+    max_ngram=int(os.getenv('LOCAL_EMBED_NGRAMS', 3))
+)
+subtree_index = FingerprintIndex(store_path('SUBTREE_INDEX_PATH', 'subtree_index.db'), version=SubtreeHasher.VERSION)
+
+# Shared pool for provider round-trips so they overlap instead of queueing
+provider_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('PROVIDER_WORKERS', 16)),
+    thread_name_prefix='provider'
+)
+
+MAX_BATCH_SUBMISSIONS = int(os.getenv('MAX_BATCH_SUBMISSIONS', 5000))
+EMBED_BATCH_MAX = int(os.getenv('EMBED_BATCH_MAX', 96))
+EMBED_BATCH_WINDOW = float(os.getenv('EMBED_BATCH_WINDOW_MS', 0)) / 1000
+
+class MicroBatcher:
+    """Coalesces embedding requests from concurrent callers into one provider call"""
+    
+    def __init__(self, embed_batch, window=0.005, max_batch_size=96):
+        self.embed_batch = embed_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+    
+    def reinitialize_after_fork(self):
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+    
+    def embed(self, texts, deadline=None):
+        """Queue texts for the next batch and block until their embeddings arrive"""
+        futures = []
+        ready = None
+        
+        with self._lock:
+            for text in texts:
+                future = Future()
+                self._pending.append((text, future, deadline))
+                futures.append(future)
+            
+            if len(self._pending) >= self.max_batch_size:
+                ready = self._take_pending()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+        
+        if ready:
+            self._run(ready)
+        return [future.result() for future in futures]
+    
+    def _take_pending(self):
+        ready, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return ready
+    
+    def _flush(self):
+        with self._lock:
+            ready = self._take_pending()
+        if ready:
+            self._run(ready)
+    
+    def _run(self, batch):
+        # Identical texts from different callers share one slot in the provider call
+        unique_texts = list(dict.fromkeys(text for text, _, _ in batch))
+        # The shared call runs until the most patient caller gives up
+        deadlines = [deadline for _, _, deadline in batch]
+        deadline = None if None in deadlines else max(deadlines)
+        try:
+            embeddings = dict(zip(unique_texts, self.embed_batch(unique_texts, deadline)))
+        except Exception as e:
+            print(f"Micro-batch embedding error: {e}")
+            embeddings = {}
+        for text, future, _ in batch:
+            future.set_result(embeddings.get(text))
+
+PROVIDER_CONNECT_TIMEOUT = float(os.getenv('PROVIDER_CONNECT_TIMEOUT', 3.05))
+PROVIDER_READ_TIMEOUT = float(os.getenv('PROVIDER_READ_TIMEOUT', 15))
+PROVIDER_RETRIES = int(os.getenv('PROVIDER_RETRIES', 2))
+PROVIDER_BACKOFF = float(os.getenv('PROVIDER_BACKOFF_MS', 200)) / 1000
+
+def create_http_session():
+    """Keep-alive session whose connection pool is sized for the provider thread pool"""
+    session = requests.Session()
+    pool_size = int(os.getenv('PROVIDER_WORKERS', 16))
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
-# Initialize APIs
-cohere_client = cohere.Client(os.getenv('COHERE_API_KEY'))
+http_session = create_http_session()
+# Created on first use: importing the SDK alone costs noticeable cold-start time
+cohere_client = None
+_cohere_client_lock = threading.Lock()
+
+def get_cohere_client():
+    """Shared Cohere client, built the first time a Cohere embedding is requested"""
+    global cohere_client
+    if cohere_client is None:
+        with _cohere_client_lock:
+            if cohere_client is None:
+                import cohere
+                # Retries are handled by call_provider so both providers share one policy. The SDK
+                # takes a single timeout per client, so one attempt cannot outlast the fan-out deadline
+                timeout = min(PROVIDER_READ_TIMEOUT, float(os.getenv('COHERE_DEADLINE', 10)))
+                cohere_client = cohere.Client(os.getenv('COHERE_API_KEY'), timeout=timeout, max_retries=0)
+    return cohere_client
+
+class ProviderError(Exception):
+    """Failed provider call; retryable unless the provider rejected the request itself"""
+    
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+class CircuitBreaker:
+    """Stops calling a provider after repeated failures and probes it again after a cool-down"""
+    
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.stats_counter = Counter()
+        self._lock = threading.Lock()
+    
+    def reinitialize_after_fork(self):
+        self._lock = threading.Lock()
+    
+    def allow(self):
+        """Whether a call may go out now; after the cool-down a single probe is let through"""
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                return True
+            if self.state != 'closed':
+                self.stats_counter['rejected'] += 1
+                return False
+            return True
+    
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.stats_counter['successes'] += 1
+    
+    def release_probe(self):
+        """Hand back an unused half-open probe, so the next call may probe instead"""
+        with self._lock:
+            if self.state == 'half_open':
+                self.state = 'open'
+    
+    def record_reachable(self):
+        """The provider answered but rejected the request: close the breaker without counting a success"""
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.stats_counter['failures'] += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.stats_counter['trips'] += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+    
+    def stats(self):
+        with self._lock:
+            retry_in = None
+            if self.state == 'open':
+                retry_in = round(max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 1)
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'retry_in_seconds': retry_in,
+                **{key: self.stats_counter[key] for key in ('successes', 'failures', 'rejected', 'trips')}
+            }
+
+def new_circuit_breakers():
+    failure_threshold = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+    reset_timeout = float(os.getenv('CIRCUIT_RESET_SECONDS', 30))
+    return {
+        name: CircuitBreaker(name, failure_threshold, reset_timeout)
+        for name in ('Cohere', 'TogetherAI')
+    }
+
+circuit_breakers = new_circuit_breakers()
+
+def call_provider(name, call, retries=None, backoff=None, deadline=None):
+    """Run a provider call with jittered exponential backoff behind that provider's circuit breaker
+    
+    call takes the read timeout for the attempt. deadline (a time.monotonic() value) caps each
+    attempt's timeout and stops retrying once the next attempt could not finish before it.
+    """
+    retries = PROVIDER_RETRIES if retries is None else retries
+    backoff = PROVIDER_BACKOFF if backoff is None else backoff
+    breaker = circuit_breakers[name]
+    
+    # Checked before the breaker, so an expired call never takes the half-open probe
+    if deadline is not None and deadline <= time.monotonic():
+        raise ProviderError(f"{name} deadline exceeded before calling", retryable=False)
+    if not breaker.allow():
+        PROVIDER_ERRORS.labels(name, 'circuit_open').inc()
+        raise ProviderError(f"{name} circuit open, skipping call", retryable=False)
+    
+    delay = 0.0
+    last_error = None
+    for attempt in range(retries + 1):
+        timeout = PROVIDER_READ_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic() - delay)
+            if timeout <= 0:
+                if last_error is None:
+                    # The caller stopped waiting before the first attempt, which says nothing about the provider
+                    breaker.release_probe()
+                    raise ProviderError(f"{name} deadline exceeded before calling", retryable=False)
+                breaker.record_failure()
+                raise last_error
+        time.sleep(delay)
+        
+        started = time.perf_counter()
+        try:
+            result = call(timeout)
+            PROVIDER_SECONDS.labels(name).observe(time.perf_counter() - started)
+            breaker.record_success()
+            return result
+        except Exception as e:
+            PROVIDER_SECONDS.labels(name).observe(time.perf_counter() - started)
+            retryable = getattr(e, 'retryable', True)
+            PROVIDER_ERRORS.labels(name, 'retryable' if retryable else 'fatal').inc()
+            if not retryable:
+                # A rejected request (4xx) means the provider is up; it must not trip the breaker
+                breaker.record_reachable()
+                raise
+            if attempt == retries:
+                breaker.record_failure()
+                raise
+            last_error = e
+            # Full jitter keeps workers that failed together from retrying together
+            delay = random.uniform(0, backoff * 2 ** attempt)
 
 class CodeSimilarityAnalyzer:
     def __init__(self):
         self.cohere_api_key = os.getenv('COHERE_API_KEY')
         self.together_api_key = os.getenv('TOGETHER_API_KEY')
         self.replicate_api_token = os.getenv('REPLICATE_API_TOKEN')
+        # Seconds each provider may take, measured from the start of the fan-out
+        self.provider_deadlines = {
+            'Cohere': float(os.getenv('COHERE_DEADLINE', 10)),
+            'TogetherAI': float(os.getenv('TOGETHER_DEADLINE', 10))
+        }
+        
+        # Optional cross-request batching; disabled when the window is 0
+        self.cohere_batcher = None
+        self.together_batcher = None
+        if EMBED_BATCH_WINDOW > 0:
+            self.cohere_batcher = MicroBatcher(self._request_cohere_embeddings, EMBED_BATCH_WINDOW, EMBED_BATCH_MAX)
+            self.together_batcher = MicroBatcher(self._request_together_embeddings, EMBED_BATCH_WINDOW, EMBED_BATCH_MAX)
         
     def get_cohere_embedding(self, text):
         """Get embedding from Cohere API"""
-        try:
-            response = cohere_client.embed(
-                texts=[text],
-                model='embed-english-v3.0',
-                input_type='search_document'
-            )
-            return response.embeddings[0]
-        except Exception as e:
-            print(f"Cohere API error: {e}")
-            return None
+        return self.get_cohere_embeddings([text])[0]
+    
+    def get_cohere_embeddings(self, texts, deadline=None):
+        """Get Cohere embeddings for many texts, embedding only cache misses"""
+        return self._get_embeddings('cohere', COHERE_EMBED_MODEL, texts, deadline,
+                                    self.cohere_batcher, self._request_cohere_embeddings)
     
     def get_together_embedding(self, text):
         """Get embedding from Together.ai API"""
+        return self.get_together_embeddings([text])[0]
+    
+    def get_together_embeddings(self, texts, deadline=None):
+        """Get Together.ai embeddings for many texts, embedding only cache misses"""
+        return self._get_embeddings('together', TOGETHER_EMBED_MODEL, texts, deadline,
+                                    self.together_batcher, self._request_together_embeddings)
+    
+    def _get_embeddings(self, provider, model, texts, deadline, batcher, request_embeddings):
+        """Serve cached embeddings and fetch the misses in as few provider calls as possible"""
+        embeddings = [embedding_cache.get(provider, model, text) for text in texts]
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        
+        if missing:
+            fetched = batcher.embed(missing, deadline) if batcher else request_embeddings(missing, deadline)
+            fetched = dict(zip(missing, fetched))
+            for text, embedding in fetched.items():
+                if embedding is not None:
+                    embedding_cache.set(provider, model, text, embedding)
+            embeddings = [embedding if embedding is not None else fetched.get(text)
+                          for text, embedding in zip(texts, embeddings)]
+        
+        return embeddings
+    
+    def _request_cohere_embeddings(self, texts, deadline=None):
+        """Embed texts with Cohere, one call per EMBED_BATCH_MAX texts"""
+        embeddings = [None] * len(texts)
+        for start in range(0, len(texts), EMBED_BATCH_MAX):
+            chunk = texts[start:start + EMBED_BATCH_MAX]
+            try:
+                # The Cohere client's own timeout already fits the deadline (see get_cohere_client)
+                response = call_provider('Cohere', lambda timeout: self._cohere_embed_call(chunk), deadline=deadline)
+                embeddings[start:start + len(chunk)] = response.embeddings
+            except Exception as e:
+                print(f"Cohere API error: {e}")
+        return embeddings
+    
+    def _cohere_embed_call(self, chunk):
         try:
-            headers = {
-                'Authorization': f'Bearer {self.together_api_key}',
-                'Content-Type': 'application/json'
-            }
-            
-            data = {
-                'model': 'BAAI/bge-base-en-v1.5',
-                'input': text
-            }
-            
-            response = requests.post(
-                'https://api.together.xyz/v1/embeddings',
-                headers=headers,
-                json=data
+            return get_cohere_client().embed(
+                texts=chunk,
+                model=COHERE_EMBED_MODEL,
+                input_type='search_document'
             )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return result['data'][0]['embedding']
-            else:
-                print(f"Together.ai API error: {response.status_code}")
-                return None
-                
         except Exception as e:
-            print(f"Together.ai API error: {e}")
-            return None
+            # Client errors other than rate limiting will not succeed on a retry
+            status = getattr(e, 'status_code', None) or getattr(e, 'http_status', None)
+            if isinstance(status, int) and 400 <= status < 500 and status != 429:
+                raise ProviderError(f"HTTP {status}: {e}", retryable=False) from e
+            raise
+    
+    def _request_together_embeddings(self, texts, deadline=None):
+        """Embed texts with Together.ai, one call per EMBED_BATCH_MAX texts"""
+        embeddings = [None] * len(texts)
+        headers = {
+            'Authorization': f'Bearer {self.together_api_key}',
+            'Content-Type': 'application/json'
+        }
+        
+        for start in range(0, len(texts), EMBED_BATCH_MAX):
+            chunk = texts[start:start + EMBED_BATCH_MAX]
+            try:
+                data = {
+                    'model': TOGETHER_EMBED_MODEL,
+                    'input': chunk
+                }
+                
+                response = call_provider('TogetherAI', lambda timeout: self._together_embed_call(headers, data, timeout),
+                                         deadline=deadline)
+                for offset, item in enumerate(response.json()['data']):
+                    embeddings[start + item.get('index', offset)] = item['embedding']
+                    
+            except Exception as e:
+                print(f"Together.ai API error: {e}")
+        
+        return embeddings
+    
+    def _together_embed_call(self, headers, data, timeout=PROVIDER_READ_TIMEOUT):
+        response = http_session.post(
+            'https://api.together.xyz/v1/embeddings',
+            headers=headers,
+            json=data,
+            timeout=(min(PROVIDER_CONNECT_TIMEOUT, timeout), timeout)
+        )
+        if response.status_code != 200:
+            # Rate limits and server errors are transient; anything else is our request's fault
+            retryable = response.status_code == 429 or response.status_code >= 500
+            raise ProviderError(f"HTTP {response.status_code}", retryable=retryable)
+        return response
     
     def get_replicate_similarity(self, code1, code2):
-        """Get similarity score from Replicate API"""
+        """Local, offline similarity score from winnowed token fingerprints"""
         try:
-            # For this demo, we'll use a simple similarity approach
-            # In production, you'd use an actual code similarity model from Replicate
-            embedding1 = self._simple_code_embedding(code1)
-            embedding2 = self._simple_code_embedding(code2)
-            
-            similarity = cosine_similarity([embedding1], [embedding2])[0][0]
-            return max(0, min(100, similarity * 100))
-            
+            return WinnowingFingerprinter.similarity(
+                fingerprinter.fingerprint(code1),
+                fingerprinter.fingerprint(code2)
+            )
         except Exception as e:
-            print(f"Replicate API error: {e}")
-            # Fallback to simple similarity
-            embedding1 = self._simple_code_embedding(code1)
-            embedding2 = self._simple_code_embedding(code2)
-            similarity = cosine_similarity([embedding1], [embedding2])[0][0]
-            return max(0, min(100, similarity * 100))
-    
-    def _simple_code_embedding(self, code):
-        """Simple code embedding for fallback"""
-        # Normalize code
-        normalized = re.sub(r'\s+', ' ', code.lower().strip())
-        
-        # Create a simple feature vector based on code characteristics
-        features = []
-        features.append(len(code))  # Length
-        features.append(code.count('def '))  # Function count
-        features.append(code.count('class '))  # Class count
-        features.append(code.count('import '))  # Import count
-        features.append(code.count('for '))  # Loop count
-        features.append(code.count('if '))  # Conditional count
-        features.append(len(re.findall(r'\w+', code)))  # Word count
-        
-        # Pad to 100 dimensions for consistency
-        while len(features) < 100:
-            features.append(0)
-        
-        return features[:100]
-    
-    def calculate_similarity(self, code1, code2):
-        """Calculate similarity scores from all three APIs"""
+            print(f"Fingerprint similarity error: {e}")
+            return 0.0
+    
+    def _submit_embeddings(self, texts):
+        """Fan out one batched embedding call per provider; returns (futures, start time)"""
+        started = time.monotonic()
+        # Each provider call stops retrying once the caller would no longer wait for it
+        pending = {
+            'Cohere': provider_executor.submit(self.get_cohere_embeddings, texts,
+                                               started + self.provider_deadlines['Cohere']),
+            'TogetherAI': provider_executor.submit(self.get_together_embeddings, texts,
+                                                   started + self.provider_deadlines['TogetherAI'])
+        }
+        return pending, started
+    
+    def _await_embeddings(self, pending, started):
+        """Wait for each provider up to its deadline; timed-out providers map to None"""
+        embeddings = {}
+        timed_out = []
+        for provider, future in pending.items():
+            remaining = max(0.0, started + self.provider_deadlines[provider] - time.monotonic())
+            with timed_stage(f'similarity.wait_{provider.lower()}'):
+                done, _ = wait([future], timeout=remaining)
+            
+            if not done:
+                # Late answers still land in the embedding cache for the next request
+                PROVIDER_TIMEOUTS.labels(provider).inc()
+                timed_out.append(provider)
+                embeddings[provider] = None
+                continue
+            embeddings[provider] = future.result()
+        return embeddings, timed_out
+    
+    @staticmethod
+    def _finish_scores(results, timed_out):
+        # Calculate final verdict (average of all scores)
+        scores = [v for v in results.values() if v > 0]
+        if scores:
+            results['FinalVerdict'] = round(sum(scores) / len(scores), 2)
+        else:
+            results['FinalVerdict'] = 0.0
+        
+        results['TimedOut'] = timed_out
+        return results
+    
+    @timed_stage('similarity')
+    def calculate_similarity(self, code1, code2, provider='remote'):
+        """Calculate similarity scores from all three APIs, or offline ones for the 'local' provider"""
+        if provider == 'local':
+            return self.calculate_local_similarity(code1, code2)
+        results = {}
+        
+        # One batched call per provider, both snippets in the same request
+        pending, started = self._submit_embeddings([code1, code2])
+        
+        # The fingerprint score is local, so compute it while the providers answer
+        with timed_stage('similarity.fingerprint'):
+            replicate_score = self.get_replicate_similarity(code1, code2)
+        
+        embeddings, timed_out = self._await_embeddings(pending, started)
+        for provider, pair in embeddings.items():
+            if pair and pair[0] and pair[1]:
+                vector1, vector2 = normalize_rows(pair)
+                provider_sim = float(vector1 @ vector2)
+                results[provider] = round(max(0, min(100, provider_sim * 100)), 2)
+            else:
+                results[provider] = 0.0
+        
+        results['Replicate'] = round(replicate_score, 2)
+        return self._finish_scores(results, timed_out)
+    
+    @timed_stage('similarity.local')
+    def calculate_local_similarity(self, code1, code2):
+        """Offline scores: the local hashed n-gram embedding and fingerprints, no provider calls"""
+        results = {
+            'Local': round(float(max(0, min(100, local_embedder.similarity(code1, code2)))), 2),
+            'Replicate': round(self.get_replicate_similarity(code1, code2), 2)
+        }
+        return self._finish_scores(results, [])
+    
+    @timed_stage('similarity.incremental')
+    def calculate_incremental_similarity(self, code1, code2):
+        """Approximation of calculate_similarity assembled from per-function chunks, so unchanged chunks are reused"""
+        results = {}
+        chunks1 = split_into_chunks(code1)
+        chunks2 = split_into_chunks(code2)
+        
+        # Unchanged chunks are served by the embedding cache; only edited ones reach a provider
+        pending, started = self._submit_embeddings([chunk['code'] for chunk in chunks1 + chunks2])
+        
+        with timed_stage('similarity.fingerprint'):
+            replicate_score = WinnowingFingerprinter.similarity(
+                chunk_fingerprints(chunks1), chunk_fingerprints(chunks2)
+            )
+        
+        embeddings, timed_out = self._await_embeddings(pending, started)
+        for provider, chunk_embeddings in embeddings.items():
+            if not chunk_embeddings or any(embedding is None for embedding in chunk_embeddings):
+                results[provider] = 0.0
+                continue
+            # File vector: unit chunk vectors weighted by chunk length
+            vector1 = combine_chunk_embeddings(chunks1, chunk_embeddings[:len(chunks1)])
+            vector2 = combine_chunk_embeddings(chunks2, chunk_embeddings[len(chunks1):])
+            provider_sim = float(vector1 @ vector2)
+            results[provider] = round(max(0, min(100, provider_sim * 100)), 2)
+        
+        results['Replicate'] = round(replicate_score, 2)
+        return self._finish_scores(results, timed_out)
+    
+    @timed_stage('similarity.chunked')
+    def calculate_chunked_similarity(self, code1, code2, max_regions=20):
+        """Scores for large files from bounded chunks: a chunk-by-chunk cosine matrix per provider plus matched regions"""
         results = {}
+        chunks1 = bounded_chunks(code1)
+        chunks2 = bounded_chunks(code2)
+        if not chunks1 or not chunks2:
+            return self.calculate_similarity(code1, code2)
         
-        # Cohere similarity
-        cohere_emb1 = self.get_cohere_embedding(code1)
-        cohere_emb2 = self.get_cohere_embedding(code2)
+        # Every chunk of both files in the same batched provider calls
+        pending, started = self._submit_embeddings([chunk['code'] for chunk in chunks1 + chunks2])
         
-        if cohere_emb1 and cohere_emb2:
-            cohere_sim = cosine_similarity([cohere_emb1], [cohere_emb2])[0][0]
-            results['Cohere'] = round(max(0, min(100, cohere_sim * 100)), 2)
+        with timed_stage('similarity.fingerprint'):
+            replicate_score = WinnowingFingerprinter.similarity(
+                chunk_fingerprints(chunks1), chunk_fingerprints(chunks2)
+            )
+        
+        weights1 = np.array([len(chunk['code']) for chunk in chunks1], dtype=np.float32)
+        weights2 = np.array([len(chunk['code']) for chunk in chunks2], dtype=np.float32)
+        matrices = []
+        embeddings, timed_out = self._await_embeddings(pending, started)
+        for provider, chunk_embeddings in embeddings.items():
+            if not chunk_embeddings or any(embedding is None for embedding in chunk_embeddings):
+                results[provider] = 0.0
+                continue
+            vectors = normalize_rows(chunk_embeddings)
+            matrix = vectors[:len(chunks1)] @ vectors[len(chunks1):].T
+            matrices.append(matrix)
+            provider_sim = best_match_score(matrix, weights1, weights2)
+            results[provider] = round(max(0, min(100, provider_sim * 100)), 2)
+        
+        results['Replicate'] = round(replicate_score, 2)
+        results = self._finish_scores(results, timed_out)
+        # Regions come from the providers' average so one provider's quirks do not dominate
+        results['MatchedRegions'] = matched_regions(
+            chunks1, chunks2, np.mean(matrices, axis=0), CHUNK_MATCH_THRESHOLD, max_regions
+        ) if matrices else []
+        return results
+    
+    def batch_similarity(self, codes, provider='cohere', top_k=5, threshold=80.0, block_size=1024):
+        """All-pairs similarity for a corpus: embed each submission once, score with matrix products"""
+        if provider == 'local':
+            # Sparse rows with IDF fitted on this corpus; nothing can fail offline
+            matrix = local_embedder.embed(codes, idf=True)
+            embedded = list(range(len(codes)))
+            failed = []
         else:
-            results['Cohere'] = 0.0
+            if provider == 'together':
+                embeddings = self.get_together_embeddings(codes)
+            else:
+                embeddings = self.get_cohere_embeddings(codes)
+            
+            embedded = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+            failed = [i for i, embedding in enumerate(embeddings) if embedding is None]
+            if not embedded:
+                return {'matches': {}, 'pairs': [], 'failed': failed}
+            
+            matrix = normalize_rows([embeddings[i] for i in embedded])
+        count = len(embedded)
+        k = min(top_k, count - 1)
+        cutoff = threshold / 100
+        matches = {}
+        pairs = []
         
-        # Together.ai similarity
-        together_emb1 = self.get_together_embedding(code1)
-        together_emb2 = self.get_together_embedding(code2)
+        # Score in row blocks so memory stays at block_size x count
+        for start in range(0, count, block_size):
+            block = matrix[start:start + block_size] @ matrix.T
+            if hasattr(block, 'toarray'):
+                block = block.toarray()
+            rows = np.arange(block.shape[0])
+            block[rows, rows + start] = -np.inf
+            
+            if k > 0:
+                top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+                top_scores = np.take_along_axis(block, top, axis=1)
+                order = np.argsort(-top_scores, axis=1)
+                top = np.take_along_axis(top, order, axis=1)
+                top_scores = np.take_along_axis(top_scores, order, axis=1)
+                for row in rows:
+                    matches[embedded[start + row]] = [
+                        (embedded[col], round(float(max(0, score)) * 100, 2))
+                        for col, score in zip(top[row], top_scores[row])
+                    ]
+            else:
+                for row in rows:
+                    matches[embedded[start + row]] = []
+            
+            # Upper triangle only, so each pair is reported once
+            hit_rows, hit_cols = np.nonzero(block >= cutoff)
+            for row, col in zip(hit_rows, hit_cols):
+                if col > start + row:
+                    pairs.append((embedded[start + row], embedded[col], round(float(block[row, col]) * 100, 2)))
         
-        if together_emb1 and together_emb2:
-            together_sim = cosine_similarity([together_emb1], [together_emb2])[0][0]
-            results['TogetherAI'] = round(max(0, min(100, together_sim * 100)), 2)
+        pairs.sort(key=lambda pair: pair[2], reverse=True)
+        return {'matches': matches, 'pairs': pairs, 'failed': failed}
+    
+    def candidate_similarity(self, codes, provider='cohere', top_k=5, threshold=80.0, min_jaccard=0.3):
+        """Corpus check that only embeds and analyzes MinHash/LSH candidate pairs"""
+        shingles = [np.unique(fingerprinter.gram_hashes(code)[0]) for code in codes]
+        candidates = minhash_lsh.candidate_pairs(minhash_lsh.signatures(shingles), min_jaccard)
+        
+        involved = sorted({i for i, j, _ in candidates} | {j for i, j, _ in candidates})
+        vectors = {}
+        if provider == 'local':
+            rows = local_embedder.embed([codes[i] for i in involved], idf=True)
+            vectors = {i: rows[position] for position, i in enumerate(involved)}
+            failed = []
         else:
-            results['TogetherAI'] = 0.0
+            if provider == 'together':
+                fetched = self.get_together_embeddings([codes[i] for i in involved])
+            else:
+                fetched = self.get_cohere_embeddings([codes[i] for i in involved])
+            embeddings = dict(zip(involved, fetched))
+            failed = [i for i in involved if embeddings[i] is None]
+            
+            usable = [i for i in involved if embeddings[i] is not None]
+            if usable:
+                vectors = dict(zip(usable, normalize_rows([embeddings[i] for i in usable])))
+        analyses = {i: code_analyzer.analyze_code_structure(codes[i]) for i in involved}
         
-        # Replicate similarity
-        replicate_score = self.get_replicate_similarity(code1, code2)
-        results['Replicate'] = round(replicate_score, 2)
+        matches = {}
+        pairs = []
+        for i, j, estimate in candidates:
+            if i not in vectors or j not in vectors:
+                continue
+            score = round(max(0.0, row_cosine(vectors[i], vectors[j])) * 100, 2)
+            matches.setdefault(i, []).append((j, score))
+            matches.setdefault(j, []).append((i, score))
+            if score >= threshold:
+                pairs.append((i, j, score, {
+                    'jaccard_estimate': round(estimate, 4),
+                    'structural_similarity': calculate_structural_similarity(analyses[i], analyses[j])['score']
+                }))
         
-        # Calculate final verdict (average of all scores)
-        scores = [v for v in results.values() if v > 0]
-        if scores:
-            results['FinalVerdict'] = round(sum(scores) / len(scores), 2)
+        for i in matches:
+            matches[i] = sorted(matches[i], key=lambda match: match[1], reverse=True)[:top_k]
+        pairs.sort(key=lambda pair: pair[2], reverse=True)
+        return {'matches': matches, 'pairs': pairs, 'failed': failed, 'candidates': len(candidates)}
+
+class VectorStore:
+    """Quantized embedding rows (float16 or int8 plus a per-row scale), memory-mapped when backed by a file"""
+    
+    DTYPES = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}
+    
+    def __init__(self, path=None, dtype='int8', dim=None, block_size=1024):
+        if dtype not in self.DTYPES:
+            raise ValueError(f'Unknown vector dtype {dtype!r}; expected one of {sorted(self.DTYPES)}')
+        self.path = path
+        self.dtype = dtype
+        self.block_size = block_size
+        self.dim = None
+        self.record_dtype = None
+        self._data = None
+        self._fd = None
+        if dim:
+            self._set_dim(dim)
+    
+    def _set_dim(self, dim):
+        self.dim = dim
+        # One fixed-size record per row, so row r lives at byte r * itemsize of the file
+        self.record_dtype = np.dtype([('scale', '<f4'), ('values', self.DTYPES[self.dtype], (dim,))])
+        if self.path:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._remap(os.fstat(self._fd).st_size // self.record_dtype.itemsize)
         else:
-            results['FinalVerdict'] = 0.0
+            self._data = np.zeros(1024, dtype=self.record_dtype)
+    
+    def _remap(self, rows):
+        # Read-only shared mapping: worker processes read the same pages from the OS page cache
+        self._data = np.memmap(self.path, dtype=self.record_dtype, mode='r', shape=(rows,)) if rows else None
+    
+    def capacity(self):
+        return 0 if self._data is None else len(self._data)
+    
+    def bytes_per_vector(self):
+        return self.record_dtype.itemsize if self.record_dtype else 0
+    
+    def encode(self, vector):
+        """Quantize one float vector into a store record"""
+        record = np.zeros(1, dtype=self.record_dtype)
+        if self.dtype == 'int8':
+            scale = float(np.abs(vector).max()) / 127 or 1.0
+            record['values'] = np.clip(np.rint(vector / scale), -127, 127)
+            record['scale'] = scale
+        else:
+            record['values'] = vector
+            record['scale'] = 1.0
+        return record
+    
+    def write(self, row, vector):
+        """Store a vector at a row; file-backed rows go straight to the file at a fixed offset"""
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.dim is None:
+            self._set_dim(vector.shape[0])
+        elif vector.shape[0] != self.dim:
+            raise ValueError(f'Embedding has {vector.shape[0]} dims, store expects {self.dim}')
+        record = self.encode(vector)
         
-        return results
+        if self._fd is None:
+            if row >= len(self._data):
+                # Grow geometrically so appends stay amortized O(1)
+                grown = np.zeros(max(row + 1, len(self._data) * 2), dtype=self.record_dtype)
+                grown[:len(self._data)] = self._data
+                self._data = grown
+            self._data[row] = record[0]
+            return
+        
+        # pwrite never shrinks the file, so concurrent writers of different rows cannot clobber each other
+        os.pwrite(self._fd, record.tobytes(), row * self.record_dtype.itemsize)
+        self.ensure(row + 1)
+    
+    def ensure(self, rows):
+        """Make sure the mapping covers the first `rows` rows, growing the file in doubling steps"""
+        if self._fd is None or rows <= self.capacity():
+            return
+        target = max(rows, 2 * self.capacity(), 1024)
+        if hasattr(os, 'posix_fallocate'):
+            # Allocation only ever extends; bytes another worker already wrote are left alone
+            os.posix_fallocate(self._fd, 0, target * self.record_dtype.itemsize)
+        self._remap(max(rows, os.fstat(self._fd).st_size // self.record_dtype.itemsize))
+    
+    def vectors(self, rows):
+        """Dequantized float32 rows for an index array or slice"""
+        records = self._data[rows]
+        return records['values'].astype(np.float32) * records['scale'][..., None]
+    
+    def scores(self, query, rows):
+        """Dot products of a query with the given rows, dequantizing one cache-sized block at a time"""
+        query = np.asarray(query, dtype=np.float32)
+        out = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), self.block_size):
+            records = self._data[rows[start:start + self.block_size]]
+            out[start:start + len(records)] = (records['values'].astype(np.float32) @ query) * records['scale']
+        return out
+    
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+class SubmissionIndex:
+    """Persistent IVF (inverted-file) index over submission embeddings with an exact fallback"""
+    
+    def __init__(self, db_path=None, n_probe=8, min_train_size=1000, refresh_interval=1.0, vector_dtype='int8'):
+        self.db_path = db_path
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.refresh_interval = refresh_interval
+        self._store = VectorStore(dtype=vector_dtype)
+        # Index row r is SQLite row r + 1 and vector store row r. Ids and metadata stay in SQLite and
+        # per-row state is a flat array, so forked workers share the loaded index copy-on-write
+        self._assignments = np.full(1024, -1, dtype=np.int32)
+        self._size = 0
+        self._centroids = None
+        self._trained_size = 0
+        self._lock = threading.RLock()
+        self._last_db_row = 0
+        self._last_refresh = 0.0
+        
+        try:
+            self._db = self._connect(db_path or ':memory:')
+            if db_path:
+                self._open_store(vector_dtype)
+                self._load()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Submission index persistence disabled: {e}")
+            self.db_path = None
+            self._db = self._connect(':memory:')
+            self._store = VectorStore(dtype=vector_dtype)
+    
+    @staticmethod
+    def _connect(path):
+        db = connect_sqlite(path)
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS submissions ('
+            'row INTEGER PRIMARY KEY, submission_id TEXT UNIQUE NOT NULL, vector BLOB NOT NULL, '
+            'metadata TEXT, created_at REAL NOT NULL)'
+        )
+        db.execute('CREATE TABLE IF NOT EXISTS index_meta (key TEXT PRIMARY KEY, value BLOB)')
+        db.commit()
+        return db
+    
+    def _open_store(self, vector_dtype):
+        # The format an existing store was written in wins over the configured one
+        stored = self._db.execute("SELECT value FROM index_meta WHERE key = 'vector_format'").fetchone()
+        vector_format = json.loads(stored[0]) if stored else {'dtype': vector_dtype, 'dim': None}
+        self._store = VectorStore(
+            os.path.splitext(self.db_path)[0] + '.vectors',
+            dtype=vector_format['dtype'],
+            dim=vector_format['dim']
+        )
+    
+    def _save_format(self):
+        self._db.execute(
+            "INSERT OR IGNORE INTO index_meta (key, value) VALUES ('vector_format', ?)",
+            (json.dumps({'dtype': self._store.dtype, 'dim': self._store.dim}),)
+        )
+    
+    def _load(self):
+        self.refresh(force=True)
+        centroids = self._db.execute("SELECT value FROM index_meta WHERE key = 'centroids'").fetchone()
+        
+        if centroids is not None and self._size:
+            self._centroids = np.frombuffer(centroids[0], dtype=np.float32).reshape(-1, self._store.dim)
+            self._assign(0, self._size)
+            self._trained_size = self._size
+    
+    def refresh(self, force=False):
+        """Pull submissions other worker processes have added to the shared store"""
+        if not self.db_path or (not force and time.monotonic() - self._last_refresh < self.refresh_interval):
+            return
+        
+        with self._lock:
+            self._last_refresh = time.monotonic()
+            try:
+                last_row = self._db.execute('SELECT MAX(row) FROM submissions').fetchone()[0] or 0
+                if last_row <= self._last_db_row:
+                    return
+                # Rows written before the vector store kept float32 vectors inline
+                inline = self._db.execute(
+                    'SELECT row, vector FROM submissions WHERE row > ? AND length(vector) > 0 ORDER BY row',
+                    (self._last_db_row,)
+                ).fetchall()
+            except sqlite3.Error as e:
+                print(f"Submission index read error: {e}")
+                return
+            
+            if self._store.dim is None:
+                # Another worker created the store since this one opened it
+                self._open_store(self._store.dtype)
+            if self._store.dim is not None:
+                self._store.ensure(last_row)
+            
+            for db_row, vector in inline:
+                self._store.write(db_row - 1, np.frombuffer(vector, dtype=np.float32))
+            if inline:
+                try:
+                    self._save_format()
+                    self._db.execute("UPDATE submissions SET vector = X'' WHERE row <= ?", (last_row,))
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"Submission index write error: {e}")
+            
+            self._grow(last_row)
+            self._last_db_row = last_row
+    
+    def reinitialize_after_fork(self):
+        self._lock = threading.RLock()
+        if self.db_path:
+            self._db = connect_sqlite(self.db_path)
+    
+    def __len__(self):
+        return self._size
+    
+    def __contains__(self, submission_id):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM submissions WHERE submission_id = ?', (submission_id,)).fetchone() is not None
+    
+    def _grow(self, rows):
+        """Cover the first `rows` rows, placing the new ones in their IVF lists"""
+        if rows <= self._size:
+            return
+        if rows > len(self._assignments):
+            grown = np.full(max(rows, 2 * len(self._assignments)), -1, dtype=np.int32)
+            grown[:self._size] = self._assignments[:self._size]
+            self._assignments = grown
+        if self._centroids is not None:
+            self._assign(self._size, rows)
+        self._size = rows
+    
+    def _assign(self, start, stop):
+        """Nearest centroid of each row in [start, stop), a block of rows at a time"""
+        for block in range(start, stop, 4096):
+            vectors = self._store.vectors(slice(block, min(block + 4096, stop)))
+            self._assignments[block:block + len(vectors)] = np.argmax(vectors @ self._centroids.T, axis=1)
+    
+    def add(self, submission_id, embedding, metadata=None):
+        """Register a submission; returns False if the id is already indexed"""
+        vector = normalize_rows(embedding)[0]
+        
+        with self._lock:
+            if self._store.dim is not None and vector.shape[0] != self._store.dim:
+                raise ValueError(f'Embedding has {vector.shape[0]} dims, index expects {self._store.dim}')
+            try:
+                cursor = self._db.execute(
+                    'INSERT OR IGNORE INTO submissions (submission_id, vector, metadata, created_at) '
+                    "VALUES (?, X'', ?, ?)",
+                    (submission_id, json.dumps(metadata or {}), time.time())
+                )
+                if not cursor.rowcount:
+                    # Already indexed, possibly by another worker
+                    self._db.commit()
+                    return False
+                row = cursor.lastrowid - 1
+                # The vector is in place before the row commits, so readers never see a missing vector
+                self._store.write(row, vector)
+                self._save_format()
+                self._db.commit()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Submission index write error: {e}")
+                self._db.rollback()
+                return False
+            
+            # Rows other workers added before this one are covered (and listed) here as well
+            self._grow(row + 1)
+            
+            # Retrain the coarse quantizer each time the corpus doubles
+            if self._size >= self.min_train_size and self._size >= 2 * self._trained_size:
+                self._train()
+        
+        return True
+    
+    def _train(self, iterations=10):
+        """Spherical k-means over a sample of the corpus, then reassign every row"""
+        n_lists = max(1, int(np.sqrt(self._size)))
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(self._size, min(self._size, n_lists * 64), replace=False))
+        sample = self._store.vectors(sample_rows)
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = np.bincount(assignments, minlength=n_lists) == 0
+            sums[empty] = centroids[empty]
+            centroids = normalize_rows(sums)
+        
+        self._centroids, self._trained_size = centroids, self._size
+        self._assign(0, self._size)
+        
+        if self.db_path:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO index_meta (key, value) VALUES ('centroids', ?)",
+                    (centroids.tobytes(),)
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Submission index write error: {e}")
+    
+    def _entries_for(self, rows):
+        """Id and metadata of each index row, read from SQLite for the rows a search returns"""
+        entries = {}
+        try:
+            for start in range(0, len(rows), FingerprintIndex.MAX_PARAMS):
+                chunk = [row + 1 for row in rows[start:start + FingerprintIndex.MAX_PARAMS]]
+                for db_row, submission_id, metadata in self._db.execute(
+                    f"SELECT row, submission_id, metadata FROM submissions WHERE row IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ):
+                    entries[db_row - 1] = (submission_id, json.loads(metadata or '{}'))
+        except sqlite3.Error as e:
+            print(f"Submission index read error: {e}")
+        return entries
+    
+    def search(self, embedding, k=10, exact=False):
+        """Return (results, rows_scanned) for the k nearest indexed submissions"""
+        vector = normalize_rows(embedding)[0]
+        self.refresh()
+        
+        with self._lock:
+            if not self._size:
+                return [], 0
+            if exact or self._centroids is None:
+                candidates = np.arange(self._size)
+            else:
+                probe = np.argsort(-(self._centroids @ vector))[:self.n_probe]
+                candidates = np.flatnonzero(np.isin(self._assignments[:self._size], probe))
+            
+            scores = self._store.scores(vector, candidates)
+            top = np.argsort(-scores)[:k]
+            entries = self._entries_for([int(candidates[i]) for i in top])
+            results = [
+                {
+                    'id': entries[int(candidates[i])][0],
+                    # Quantization error can push a self-match a hair past 1
+                    'score': round(float(min(1, max(0, scores[i]))) * 100, 2),
+                    'metadata': entries[int(candidates[i])][1]
+                }
+                for i in top if int(candidates[i]) in entries
+            ]
+            return results, len(candidates)
+    
+    def measure_recall(self, k=10, sample_size=100):
+        """Recall@k of the approximate search against brute force, using indexed rows as queries"""
+        with self._lock:
+            if self._centroids is None or not self._size:
+                return 1.0
+            rng = np.random.default_rng(0)
+            queries = rng.choice(self._size, min(sample_size, self._size), replace=False)
+            found = 0
+            for row in queries:
+                query = self._store.vectors(row)
+                approximate, _ = self.search(query, k)
+                expected, _ = self.search(query, k, exact=True)
+                found += len({r['id'] for r in approximate} & {r['id'] for r in expected})
+            return found / (len(queries) * min(k, self._size))
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'submissions': self._size,
+                'lists': 0 if self._centroids is None else len(self._centroids),
+                'trained': self._centroids is not None,
+                'n_probe': self.n_probe,
+                'persistent': self.db_path is not None,
+                'vector_dtype': self._store.dtype,
+                'vector_bytes': self._size * self._store.bytes_per_vector()
+            }
+
+# Known AI-generated code samples used when no reference file is configured
+DEFAULT_AI_SAMPLES = [
+    "def calculate_factorial(n):\n    if n == 0 or n == 1:\n        return 1\n    else:\n        return n * calculate_factorial(n - 1)",
+    "def fibonacci(n):\n    if n <= 1:\n        return n\n    return fibonacci(n-1) + fibonacci(n-2)",
+    "def bubble_sort(arr):\n    n = len(arr)\n    for i in range(n):\n        for j in range(0, n-i-1):\n            if arr[j] > arr[j+1]:\n                arr[j], arr[j+1] = arr[j+1], arr[j]\n    return arr"
+]
+
+class AIReferenceLibrary:
+    """Reference set of AI-generated samples, embedded once and pinned as a normalized matrix"""
+    
+    def __init__(self, similarity_analyzer, samples_path=None, retry_after=30, max_retry_after=900):
+        self.similarity_analyzer = similarity_analyzer
+        self.samples_path = samples_path
+        self.retry_after = retry_after
+        self.max_retry_after = max_retry_after
+        self._matrix = None
+        # Samples still to embed (None until loaded), retried on a doubling timer
+        self._missing = None
+        self._failures = 0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+    
+    def load_samples(self):
+        """Load samples from a JSON file (list of strings or {"samples": [...]})"""
+        if not self.samples_path:
+            return list(DEFAULT_AI_SAMPLES)
+        
+        with open(self.samples_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        samples = data.get('samples', []) if isinstance(data, dict) else data
+        return [sample for sample in samples if isinstance(sample, str) and sample.strip()]
+    
+    def matrix(self):
+        """Return the pinned (n_samples, dim) matrix of every sample embedded so far, embedding on first use"""
+        if self._matrix is None or self._retry_due():
+            # Requests that already have a matrix never wait behind a retry
+            if self._lock.acquire(blocking=self._matrix is None):
+                try:
+                    if self._missing is None or self._retry_due():
+                        self._embed_missing()
+                finally:
+                    self._lock.release()
+        
+        if self._matrix is None:
+            raise RuntimeError(f'No AI reference samples embedded yet; next attempt in {self._retry_at - time.monotonic():.0f}s')
+        return self._matrix
+    
+    def _retry_due(self):
+        return bool(self._missing) and time.monotonic() >= self._retry_at
+    
+    def _embed_missing(self):
+        if self._missing is None:
+            self._missing = self.load_samples()
+        samples = self._missing
+        embeddings = self.similarity_analyzer.get_cohere_embeddings(samples)
+        embedded = [embedding for embedding in embeddings if embedding is not None]
+        
+        if embedded:
+            rows = normalize_rows(embedded)
+            self._matrix = rows if self._matrix is None else np.vstack([self._matrix, rows])
+        self._missing = [sample for sample, embedding in zip(samples, embeddings) if embedding is None]
+        
+        if self._missing:
+            delay = min(self.max_retry_after, self.retry_after * 2 ** self._failures)
+            self._failures += 1
+            self._retry_at = time.monotonic() + delay
+            print(f"AI reference samples: {len(self._missing)} not embedded, retrying in {delay:.0f}s")
+    
+    def similarities(self, embedding):
+        """Cosine similarity of one embedding against every reference sample"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+        return self.matrix() @ vector
 
 class CodeAnalyzer:
     """Advanced code analysis for detailed insights and AI detection"""
     
-    def __init__(self):
-        self.cohere_client = cohere_client
+    def __init__(self, similarity_analyzer=None):
+        self.similarity_analyzer = similarity_analyzer or CodeSimilarityAnalyzer()
+        self.ai_references = AIReferenceLibrary(
+            self.similarity_analyzer, os.getenv('AI_SAMPLES_PATH'),
+            retry_after=float(os.getenv('AI_REFERENCE_RETRY_SECONDS', 30))
+        )
         
+    @timed_stage('analysis')
     def analyze_code_structure(self, code):
-        """Analyze code structure and complexity"""
+        """Analyze code structure and complexity from a single parse and tree walk"""
         try:
-            tree = ast.parse(code)
+            with timed_stage('analysis.parse'):
+                tree = ast.parse(code)
+            with timed_stage('analysis.scan'):
+                features = feature_scanner.scan(code)
             
             analysis = {
-                'lines_of_code': len([line for line in code.split('\n') if line.strip()]),
+                'lines_of_code': features['lines_of_code'],
                 'functions': [],
                 'classes': [],
                 'imports': [],
@@ -169,30 +1937,47 @@ class CodeAnalyzer:
                 'code_patterns': {}
             }
             
-            for node in ast.walk(tree):
-                if isinstance(node, ast.FunctionDef):
-                    analysis['functions'].append({
-                        'name': node.name,
-                        'args': len(node.args.args),
-                        'line': node.lineno,
-                        'docstring': ast.get_docstring(node) is not None
-                    })
-                elif isinstance(node, ast.ClassDef):
-                    analysis['classes'].append({
-                        'name': node.name,
-                        'line': node.lineno,
-                        'methods': len([n for n in node.body if isinstance(n, ast.FunctionDef)])
-                    })
-                elif isinstance(node, ast.Import):
-                    analysis['imports'].extend([alias.name for alias in node.names])
-                elif isinstance(node, ast.ImportFrom):
-                    analysis['imports'].append(node.module or 'relative')
-                elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
-                    analysis['variables'].append(node.id)
+            decision_nodes = 0
+            block_nodes = 0
+            
+            with timed_stage('analysis.walk'):
+                for node in ast.walk(tree):
+                    if isinstance(node, ast.FunctionDef):
+                        analysis['functions'].append({
+                            'name': node.name,
+                            'args': len(node.args.args),
+                            'line': node.lineno,
+                            'docstring': ast.get_docstring(node) is not None
+                        })
+                    elif isinstance(node, ast.ClassDef):
+                        analysis['classes'].append({
+                            'name': node.name,
+                            'line': node.lineno,
+                            'methods': len([n for n in node.body if isinstance(n, ast.FunctionDef)])
+                        })
+                    elif isinstance(node, ast.Import):
+                        analysis['imports'].extend([alias.name for alias in node.names])
+                    elif isinstance(node, ast.ImportFrom):
+                        analysis['imports'].append(node.module or 'relative')
+                    elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+                        analysis['variables'].append(node.id)
+                    elif isinstance(node, (ast.If, ast.While, ast.For, ast.With, ast.Try, ast.ExceptHandler)):
+                        decision_nodes += 1
+                        block_nodes += 1
+                    elif isinstance(node, ast.BoolOp):
+                        decision_nodes += len(node.values) - 1
             
             # Calculate complexity metrics
-            analysis['complexity_metrics'] = self._calculate_complexity(code, tree)
-            analysis['code_patterns'] = self._analyze_patterns(code)
+            analysis['complexity_metrics'] = self._calculate_complexity(
+                analysis['lines_of_code'], decision_nodes, block_nodes
+            )
+            analysis['code_patterns'] = {
+                'naming_conventions': features['naming_conventions'],
+                'code_style': features['code_style'],
+                'ai_indicators': features['ai_indicators']
+            }
+            with timed_stage('analysis.subtrees'):
+                analysis['subtree_hashes'] = subtree_hasher.hashes(tree)
             
             return analysis
             
@@ -201,8 +1986,8 @@ class CodeAnalyzer:
         except Exception as e:
             return {'error': f'Analysis error: {str(e)}'}
     
-    def _calculate_complexity(self, code, tree):
-        """Calculate various complexity metrics"""
+    def _calculate_complexity(self, loc, decision_nodes, block_nodes):
+        """Calculate various complexity metrics from counts gathered during the tree walk"""
         complexity = {
             'cyclomatic_complexity': 1,  # Base complexity
             'cognitive_complexity': 0,
@@ -210,139 +1995,22 @@ class CodeAnalyzer:
             'maintainability_index': 0
         }
         
-        # Count decision points for cyclomatic complexity
-        decision_nodes = 0
-        max_depth = 0
-        current_depth = 0
-        
-        for node in ast.walk(tree):
-            if isinstance(node, (ast.If, ast.While, ast.For, ast.With, ast.Try, ast.ExceptHandler)):
-                decision_nodes += 1
-                current_depth += 1
-                max_depth = max(max_depth, current_depth)
-            elif isinstance(node, ast.BoolOp):
-                decision_nodes += len(node.values) - 1
-        
         complexity['cyclomatic_complexity'] += decision_nodes
-        complexity['nesting_depth'] = max_depth
+        complexity['nesting_depth'] = block_nodes
         
         # Simple maintainability index approximation
-        loc = len([line for line in code.split('\n') if line.strip()])
-        complexity['maintainability_index'] = max(0, 171 - 5.2 * np.log(loc) - 0.23 * complexity['cyclomatic_complexity'])
+        complexity['maintainability_index'] = max(0, 171 - 5.2 * math.log(max(loc, 1)) - 0.23 * complexity['cyclomatic_complexity'])
         
         return complexity
     
-    def _analyze_patterns(self, code):
-        """Analyze code patterns and style"""
-        patterns = {
-            'naming_conventions': self._check_naming_conventions(code),
-            'code_style': self._analyze_code_style(code),
-            'ai_indicators': self._detect_ai_patterns(code)
-        }
-        return patterns
-    
-    def _check_naming_conventions(self, code):
-        """Check naming conventions"""
-        lines = code.split('\n')
-        conventions = {
-            'snake_case_functions': 0,
-            'camelCase_functions': 0,
-            'UPPERCASE_constants': 0,
-            'single_letter_vars': 0,
-            'descriptive_names': 0
-        }
-        
-        function_pattern = re.compile(r'def\s+([a-zA-Z_][a-zA-Z0-9_]*)')
-        
-        for line in lines:
-            # Check function names
-            func_matches = function_pattern.findall(line)
-            for func_name in func_matches:
-                if '_' in func_name and func_name.islower():
-                    conventions['snake_case_functions'] += 1
-                elif re.match(r'^[a-z]+[A-Z]', func_name):
-                    conventions['camelCase_functions'] += 1
-                
-                if len(func_name) > 3:
-                    conventions['descriptive_names'] += 1
-            
-            # Check for constants
-            if re.search(r'[A-Z_]{2,}\s*=', line):
-                conventions['UPPERCASE_constants'] += 1
-                
-            # Check for single letter variables
-            if re.search(r'\b[a-z]\s*=', line):
-                conventions['single_letter_vars'] += 1
-        
-        return conventions
-    
-    def _analyze_code_style(self, code):
-        """Analyze code style patterns"""
-        lines = code.split('\n')
-        style = {
-            'avg_line_length': np.mean([len(line) for line in lines]) if lines else 0,
-            'empty_lines': len([line for line in lines if not line.strip()]),
-            'comments': len([line for line in lines if line.strip().startswith('#')]),
-            'docstrings': len(re.findall(r'""".*?"""', code, re.DOTALL)),
-            'indentation_style': 'spaces' if '    ' in code else 'tabs' if '\t' in code else 'mixed'
-        }
-        return style
-    
-    def _detect_ai_patterns(self, code):
-        """Detect patterns that might indicate AI-generated code"""
-        ai_indicators = {
-            'score': 0,
-            'indicators': [],
-            'confidence': 'low'
-        }
-        
-        # Common AI-generated code patterns
-        ai_patterns = [
-            (r'# This function', 'Generic function comments'),
-            (r'# Initialize|# Create|# Set up', 'Verbose initialization comments'),
-            (r'def\s+\w+\(.*\):\s*""".*?"""', 'Detailed docstrings for simple functions'),
-            (r'if\s+__name__\s*==\s*[\'"]__main__[\'"]:', 'Standard main guard'),
-            (r'import\s+\w+\s*\n\s*import', 'Organized imports'),
-            (r'try:\s*\n.*?except.*?:', 'Exception handling patterns'),
-            (r'\.format\(|f[\'"].*?\{.*?\}', 'Modern string formatting'),
-            (r'list\(.*?\)|dict\(.*?\)', 'Explicit type conversions'),
-        ]
-        
-        for pattern, description in ai_patterns:
-            if re.search(pattern, code, re.DOTALL | re.MULTILINE):
-                ai_indicators['score'] += 10
-                ai_indicators['indicators'].append(description)
-        
-        # Check for overly perfect structure
-        lines = [line for line in code.split('\n') if line.strip()]
-        if lines:
-            # Perfect indentation
-            indented_lines = [line for line in lines if line.startswith('    ')]
-            if len(indented_lines) > len(lines) * 0.3:
-                ai_indicators['score'] += 15
-                ai_indicators['indicators'].append('Consistent indentation pattern')
-            
-            # Balanced comment ratio
-            comment_ratio = len([line for line in lines if line.strip().startswith('#')]) / len(lines)
-            if 0.1 <= comment_ratio <= 0.3:
-                ai_indicators['score'] += 10
-                ai_indicators['indicators'].append('Optimal comment density')
-        
-        # Determine confidence level
-        if ai_indicators['score'] >= 60:
-            ai_indicators['confidence'] = 'high'
-        elif ai_indicators['score'] >= 30:
-            ai_indicators['confidence'] = 'medium'
-        else:
-            ai_indicators['confidence'] = 'low'
-        
-        return ai_indicators
-    
-    def detect_ai_generated_code(self, code):
-        """Main AI detection function using multiple approaches"""
+    @timed_stage('ai_detection')
+    def detect_ai_generated_code(self, code, structure_analysis=None, semantic=True):
+        """Main AI detection function using multiple approaches; semantic=False stays offline"""
         try:
-            # Get code analysis
-            structure_analysis = self.analyze_code_structure(code)
+            # Reuse the caller's structure analysis instead of parsing again
+            if structure_analysis is None:
+                with timed_stage('ai_detection.structure'):
+                    structure_analysis = self.analyze_code_structure(code)
             
             if 'error' in structure_analysis:
                 return {'error': structure_analysis['error']}
@@ -350,11 +2018,17 @@ class CodeAnalyzer:
             # AI detection based on patterns
             ai_patterns = structure_analysis.get('code_patterns', {}).get('ai_indicators', {})
             
-            # Use Cohere for semantic analysis
-            semantic_analysis = self._semantic_ai_detection(code)
-            
-            # Combine results
-            final_score = (ai_patterns.get('score', 0) + semantic_analysis.get('score', 0)) / 2
+            if semantic:
+                # Use Cohere for semantic analysis
+                with timed_stage('ai_detection.semantic'):
+                    semantic_analysis = self._semantic_ai_detection(code)
+                
+                # Combine results
+                final_score = (ai_patterns.get('score', 0) + semantic_analysis.get('score', 0)) / 2
+            else:
+                # Offline the pattern score stands alone instead of being halved by a missing semantic score
+                semantic_analysis = {'score': 0, 'skipped': 'local provider'}
+                final_score = ai_patterns.get('score', 0)
             
             result = {
                 'ai_probability': min(100, final_score),
@@ -373,34 +2047,15 @@ class CodeAnalyzer:
     def _semantic_ai_detection(self, code):
         """Use Cohere to analyze semantic patterns for AI detection"""
         try:
-            # Known AI-generated code samples for comparison
-            ai_samples = [
-                "def calculate_factorial(n):\n    if n == 0 or n == 1:\n        return 1\n    else:\n        return n * calculate_factorial(n - 1)",
-                "def fibonacci(n):\n    if n <= 1:\n        return n\n    return fibonacci(n-1) + fibonacci(n-2)",
-                "def bubble_sort(arr):\n    n = len(arr)\n    for i in range(n):\n        for j in range(0, n-i-1):\n            if arr[j] > arr[j+1]:\n                arr[j], arr[j+1] = arr[j+1], arr[j]\n    return arr"
-            ]
+            code_embedding = self.similarity_analyzer.get_cohere_embedding(code)
+            if code_embedding is None:
+                return {'score': 0, 'error': 'Cohere embedding unavailable'}
             
-            # Get embeddings
-            code_embedding = self.cohere_client.embed(
-                texts=[code],
-                model='embed-english-v3.0',
-                input_type='search_document'
-            ).embeddings[0]
+            # Single vectorized pass against the pinned reference matrix
+            similarities = self.ai_references.similarities(code_embedding)
             
-            ai_embeddings = self.cohere_client.embed(
-                texts=ai_samples,
-                model='embed-english-v3.0',
-                input_type='search_document'
-            ).embeddings
-            
-            # Calculate similarities
-            similarities = []
-            for ai_emb in ai_embeddings:
-                sim = cosine_similarity([code_embedding], [ai_emb])[0][0]
-                similarities.append(sim)
-            
-            avg_similarity = np.mean(similarities)
-            max_similarity = max(similarities)
+            avg_similarity = float(similarities.mean())
+            max_similarity = float(similarities.max())
             
             # Convert to AI probability score
             semantic_score = max_similarity * 100
@@ -429,7 +2084,725 @@ class CodeAnalyzer:
 
 # Initialize global instances
 analyzer = CodeSimilarityAnalyzer()
-code_analyzer = CodeAnalyzer()
+code_analyzer = CodeAnalyzer(analyzer)
+
+SUBMISSION_INDEX_PROVIDER = os.getenv('SUBMISSION_INDEX_PROVIDER', 'cohere')
+submission_index = SubmissionIndex(
+    db_path=store_path('SUBMISSION_INDEX_PATH', 'submission_index.db'),
+    n_probe=int(os.getenv('SUBMISSION_INDEX_PROBES', 8)),
+    min_train_size=int(os.getenv('SUBMISSION_INDEX_MIN_TRAIN', 1000)),
+    vector_dtype=os.getenv('SUBMISSION_INDEX_DTYPE', 'int8')
+)
+
+def submission_key(code):
+    """Content hash used as the default id of an indexed submission"""
+    return hashlib.sha256(re.sub(r'\s+', ' ', code.strip()).encode('utf-8')).hexdigest()
+
+def get_index_embeddings(codes):
+    """Embeddings from the provider the submission index is built on"""
+    if SUBMISSION_INDEX_PROVIDER == 'together':
+        return analyzer.get_together_embeddings(codes)
+    return analyzer.get_cohere_embeddings(codes)
+
+def register_submissions(codes, labels=None, embed=True):
+    """Add submissions to the indexes under their content hash; embed=False keeps to the offline indexes"""
+    try:
+        labels = labels or [None] * len(codes)
+        for code in codes:
+            key = submission_key(code)
+            fingerprint_index.add(key, fingerprinter.fingerprint(code))
+            try:
+                subtree_index.add(key, subtree_hasher.hashes(ast.parse(code)))
+            except SyntaxError:
+                pass
+        if not embed:
+            return
+        for code, label, embedding in zip(codes, labels, get_index_embeddings(codes)):
+            if embedding is not None:
+                submission_index.add(submission_key(code), embedding, {
+                    'label': label,
+                    'registered_at': datetime.now().isoformat(),
+                    'lines': code.count('\n') + 1
+                })
+    except Exception as e:
+        print(f"Submission registration error: {e}")
+
+# Registration gets its own small pool: a cache miss makes slow provider calls that must not
+# occupy the threads interactive comparisons fan out on
+REGISTRATION_WORKERS = int(os.getenv('REGISTRATION_WORKERS', 2))
+REGISTRATION_QUEUE = int(os.getenv('REGISTRATION_QUEUE', 256))
+registration_executor = ThreadPoolExecutor(max_workers=REGISTRATION_WORKERS, thread_name_prefix='register')
+registration_slots = threading.BoundedSemaphore(REGISTRATION_QUEUE)
+
+def schedule_registration(codes, labels=None, embed=True):
+    """Queue submissions for background registration; dropped (and counted) when the queue is full"""
+    if not registration_slots.acquire(blocking=False):
+        REGISTRATIONS_DROPPED.inc()
+        return None
+    slots = registration_slots
+    future = registration_executor.submit(register_submissions, codes, labels, embed)
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+INGEST_EXTENSIONS = tuple(ext.strip() for ext in os.getenv('INGEST_EXTENSIONS', '.py').split(',') if ext.strip())
+INGEST_MAX_FILE_BYTES = int(os.getenv('INGEST_MAX_FILE_BYTES', 1024 * 1024))
+
+def _wanted_member(name, size):
+    base = os.path.basename(name)
+    return (name.endswith(INGEST_EXTENSIONS) and not base.startswith('.')
+            and '__MACOSX' not in name and size <= INGEST_MAX_FILE_BYTES)
+
+def iter_archive_sources(fileobj, seekable=True):
+    """Yield (name, source) for each source file in a zip or tar archive, one member at a time"""
+    if seekable:
+        magic = fileobj.read(4)
+        fileobj.seek(0)
+        if magic == b'PK\x03\x04':
+            with zipfile.ZipFile(fileobj) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and _wanted_member(info.filename, info.file_size):
+                        with archive.open(info) as member:
+                            yield info.filename, member.read().decode('utf-8', errors='replace')
+            return
+    
+    # Stream mode ('r|*') reads tar members sequentially and never seeks
+    with tarfile.open(fileobj=fileobj, mode='r:*' if seekable else 'r|*') as archive:
+        for member in archive:
+            if member.isfile() and _wanted_member(member.name, member.size):
+                extracted = archive.extractfile(member)
+                if extracted is not None:
+                    yield member.name, extracted.read().decode('utf-8', errors='replace')
+
+class JobQueue:
+    """SQLite-backed job store with a local worker pool for long-running comparisons"""
+    
+    def __init__(self, db_path=None, workers=2, stale_after=60):
+        self.db_path = db_path
+        self.workers = workers
+        self.stale_after = stale_after
+        self.handlers = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._running = set()
+        # Queued jobs waiting in this process's executor; heartbeated like running ones
+        self._pending = set()
+        self._sweeper = None
+        self._db = connect_sqlite(db_path or ':memory:')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, progress REAL NOT NULL, '
+            'payload TEXT NOT NULL, result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+        )
+        # One process at a time holds the recovery lease; it lapses if that process dies
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS job_leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._db.commit()
+    
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            self._db.commit()
+            return cursor
+    
+    def reinitialize_after_fork(self):
+        """Threads do not survive fork: give the worker its own pool, lock and connection"""
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+        self._running = set()
+        self._pending = set()
+        self._sweeper = None
+        if self.db_path:
+            self._db = connect_sqlite(self.db_path)
+    
+    def start(self):
+        """Start the sweeper thread; call once per serving process, after any fork (see gunicorn.conf.py)"""
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep_forever, name='job-sweeper', daemon=True)
+            self._sweeper.start()
+    
+    def _sweep_forever(self):
+        holder = f'{os.getpid()}:{uuid.uuid4().hex}'
+        while True:
+            try:
+                self._heartbeat()
+                if self._hold_lease(holder):
+                    self.recover()
+            except Exception as e:
+                print(f"Job sweep error: {e}")
+            time.sleep(self.stale_after / 3)
+    
+    def _heartbeat(self):
+        """Keep this process's running jobs, and the queued ones waiting in its pool, from looking abandoned"""
+        owned = tuple(self._running | self._pending)
+        if owned:
+            self._execute(
+                "UPDATE jobs SET updated_at = ? WHERE status IN ('queued', 'running') "
+                f"AND id IN ({', '.join('?' * len(owned))})",
+                (time.time(), *owned)
+            )
+    
+    def _hold_lease(self, holder):
+        """Take or renew the recovery lease; only its holder requeues abandoned jobs"""
+        now = time.time()
+        return self._execute(
+            "INSERT INTO job_leases (name, holder, expires_at) VALUES ('recovery', ?, ?) "
+            'ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at '
+            'WHERE job_leases.holder = excluded.holder OR job_leases.expires_at < ?',
+            (holder, now + self.stale_after, now)
+        ).rowcount == 1
+    
+    def register(self, kind, handler):
+        """handler(payload, report_progress) -> JSON-serializable result"""
+        self.handlers[kind] = handler
+    
+    def submit(self, kind, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            'INSERT INTO jobs (id, kind, status, progress, payload, created_at, updated_at) '
+            "VALUES (?, ?, 'queued', 0, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), now, now)
+        )
+        self._pending.add(job_id)
+        self._executor.submit(self._run, job_id)
+        return job_id
+    
+    def get(self, job_id, include_result=False):
+        row = self._execute(
+            'SELECT id, kind, status, progress, error, created_at, updated_at, result FROM jobs WHERE id = ?',
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        
+        job = {
+            'job_id': row[0],
+            'type': row[1],
+            'status': row[2],
+            'progress': round(row[3], 4),
+            'error': row[4],
+            'created_at': datetime.fromtimestamp(row[5]).isoformat(),
+            'updated_at': datetime.fromtimestamp(row[6]).isoformat()
+        }
+        if include_result and row[7] is not None:
+            job['result'] = json.loads(row[7])
+        return job
+    
+    def recover(self):
+        """Requeue queued or running jobs without a recent heartbeat, left by a process that went away"""
+        cutoff = time.time() - self.stale_after
+        stale = self._execute(
+            "SELECT id, status FROM jobs WHERE status IN ('queued', 'running') AND updated_at < ?", (cutoff,)
+        ).fetchall()
+        recovered = 0
+        for job_id, status in stale:
+            # Conditional, so a job whose owner heartbeats in the meantime is left alone; the fresh
+            # updated_at and this process's heartbeat keep it from being resubmitted on the next sweep
+            if job_id in self._pending or not self._execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE id = ? AND status = ? AND updated_at < ?",
+                (time.time(), job_id, status, cutoff)
+            ).rowcount:
+                continue
+            self._pending.add(job_id)
+            self._executor.submit(self._run, job_id)
+            recovered += 1
+        return recovered
+    
+    def _run(self, job_id):
+        # Claiming is a conditional update, so a job runs once even with several worker processes
+        claimed = self._execute(
+            "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id)
+        ).rowcount
+        if not claimed:
+            self._pending.discard(job_id)
+            return
+        self._running.add(job_id)
+        self._pending.discard(job_id)
+        try:
+            self._run_claimed(job_id)
+        finally:
+            self._running.discard(job_id)
+    
+    def _run_claimed(self, job_id):
+        kind, payload = self._execute('SELECT kind, payload FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        
+        def report_progress(done, total):
+            self._execute(
+                'UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?',
+                (done / total if total else 1.0, time.time(), job_id)
+            )
+        
+        try:
+            result = self.handlers[kind](json.loads(payload), report_progress)
+            self._execute(
+                "UPDATE jobs SET status = 'completed', progress = 1, result = ?, updated_at = ? WHERE id = ?",
+                (dumps_json(result).decode('utf-8'), time.time(), job_id)
+            )
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            self._execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                (str(e), time.time(), job_id)
+            )
+
+def run_compare_job(payload, report_progress):
+    """calculate_similarity over every submitted pair"""
+    pairs = payload['pairs']
+    # Jobs queued before providers were selectable are remote
+    provider = payload.get('provider', 'remote')
+    results = []
+    for done, pair in enumerate(pairs, 1):
+        scores = analyzer.calculate_similarity(pair['code1'], pair['code2'], provider)
+        results.append(dict(scores, id=pair.get('id', done - 1)))
+        report_progress(done, len(pairs))
+    return {'results': results}
+
+def run_detect_job(payload, report_progress):
+    """detect_ai_generated_code over every submitted snippet"""
+    codes = payload['codes']
+    semantic = payload.get('provider', 'remote') != 'local'
+    results = []
+    for done, code in enumerate(codes, 1):
+        detection = code_analyzer.detect_ai_generated_code(code, semantic=semantic)
+        detection.pop('structure_analysis', None)
+        results.append(detection)
+        report_progress(done, len(codes))
+    return {'results': results}
+
+job_queue = JobQueue(
+    db_path=store_path('JOB_STORE_PATH', 'jobs.db'),
+    workers=int(os.getenv('JOB_WORKERS', 2)),
+    stale_after=float(os.getenv('JOB_STALE_SECONDS', 60))
+)
+job_queue.register('compare', run_compare_job)
+job_queue.register('detect', run_detect_job)
+
+# Flat per-file record returned by analysis worker processes (cheap to pickle)
+COMPACT_ANALYSIS_FIELDS = (
+    'lines', 'functions', 'classes', 'imports', 'variables', 'cyclomatic', 'maintainability_index',
+    'nesting_depth', 'snake_case_functions', 'camelCase_functions', 'comments', 'avg_line_length',
+    'indentation_style', 'ai_pattern_score', 'ai_indicators', 'error'
+)
+# gunicorn.conf.py sets the default to this worker's share of the CPUs; never more processes than CPUs
+ANALYSIS_WORKERS = min(int(os.getenv('ANALYSIS_WORKERS', os.cpu_count() or 1)), os.cpu_count() or 1)
+ANALYSIS_CHUNK_SIZE = int(os.getenv('ANALYSIS_CHUNK_SIZE', 0))
+_analysis_pool = None
+_analysis_pool_lock = threading.Lock()
+
+def analyze_code_compact(code):
+    """Run the full structure/style/pattern analysis and keep only a flat tuple of results"""
+    analysis = code_analyzer.analyze_code_structure(code)
+    if 'error' in analysis:
+        return (None,) * (len(COMPACT_ANALYSIS_FIELDS) - 1) + (analysis['error'],)
+    
+    complexity = analysis['complexity_metrics']
+    patterns = analysis['code_patterns']
+    return (
+        analysis['lines_of_code'], len(analysis['functions']), len(analysis['classes']),
+        len(analysis['imports']), len(analysis['variables']), complexity['cyclomatic_complexity'],
+        float(complexity['maintainability_index']), complexity['nesting_depth'],
+        patterns['naming_conventions']['snake_case_functions'], patterns['naming_conventions']['camelCase_functions'],
+        patterns['code_style']['comments'], float(patterns['code_style']['avg_line_length']),
+        patterns['code_style']['indentation_style'], patterns['ai_indicators']['score'],
+        tuple(patterns['ai_indicators']['indicators']), None
+    )
+
+def get_analysis_pool():
+    """Process pool for CPU-bound analysis, created on first use"""
+    global _analysis_pool
+    with _analysis_pool_lock:
+        if _analysis_pool is None:
+            # Never fork the threaded serving process: locks held by other threads would be copied locked
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            # The initializer must not live in this module: process arguments are unpickled before
+            # parent_process() is set, so importing this module then would open the stores
+            _analysis_pool = ProcessPoolExecutor(
+                max_workers=ANALYSIS_WORKERS, mp_context=context,
+                initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN)
+            )
+        return _analysis_pool
+
+def analyze_batch(codes, chunk_size=None):
+    """Analyze many files across the process pool; returns one flat dict per file"""
+    if ANALYSIS_WORKERS <= 1 or len(codes) < 2:
+        rows = map(analyze_code_compact, codes)
+    else:
+        chunk_size = chunk_size or ANALYSIS_CHUNK_SIZE or max(1, len(codes) // (ANALYSIS_WORKERS * 4))
+        rows = get_analysis_pool().map(analyze_code_compact, codes, chunksize=chunk_size)
+    return [dict(zip(COMPACT_ANALYSIS_FIELDS, row)) for row in rows]
+
+# Chunked comparison of large files: chunk bounds and the cosine a matched region must reach
+CHUNK_MAX_LINES = int(os.getenv('CHUNK_MAX_LINES', 60))
+# bge-base-en-v1.5 reads at most 512 tokens, and its WordPiece vocabulary splits source code into
+# roughly one token per 3 characters, so longer chunks would be silently truncated by the provider
+CHUNK_MAX_CHARS = int(os.getenv('CHUNK_MAX_CHARS', 1500))
+CHUNK_OVERLAP_LINES = int(os.getenv('CHUNK_OVERLAP_LINES', 10))
+# Per file; also bounds each provider's chunk-by-chunk matrix (1024 x 1024 float32 is 4 MB)
+CHUNK_MAX_CHUNKS = int(os.getenv('CHUNK_MAX_CHUNKS', 1024))
+CHUNK_MATCH_THRESHOLD = float(os.getenv('CHUNK_MATCH_THRESHOLD', 0.9))
+CHUNKED_CHECK_MIN_LINES = int(os.getenv('CHUNKED_CHECK_MIN_LINES', 0))
+
+# Bump when a change to the scoring code alters comparison results
+RESULT_SCHEMA_VERSION = 2
+
+def scoring_config_version():
+    """Digest of everything that shapes comparison results; cached results never outlive it"""
+    config = {
+        'schema': RESULT_SCHEMA_VERSION,
+        'models': [COHERE_EMBED_MODEL, TOGETHER_EMBED_MODEL],
+        'fingerprint': [fingerprinter.k, fingerprinter.window],
+        'subtree_min_size': subtree_hasher.min_size,
+        'ai_samples': os.getenv('AI_SAMPLES_PATH') or 'default',
+        'chunks': [CHUNK_MAX_LINES, CHUNK_MAX_CHARS, CHUNK_OVERLAP_LINES, CHUNK_MATCH_THRESHOLD, CHUNK_MAX_CHUNKS],
+        'local_embedding': [local_embedder.n_features, local_embedder.max_ngram]
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+class ResultCache:
+    """Bounded LRU of finished comparison results, keyed by pair digest and scoring configuration"""
+    
+    def __init__(self, max_size=1024, ttl=3600, config_version=''):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.config_version = config_version
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats_counter = Counter()
+    
+    def reinitialize_after_fork(self):
+        self._lock = threading.Lock()
+    
+    def pair_key(self, kind, code1, code2, symmetric=True):
+        """Symmetric keys ignore order and whitespace; ordered keys are for results that show both sides"""
+        if symmetric:
+            digests = sorted(
+                hashlib.sha256(re.sub(r'\s+', ' ', code.strip()).encode('utf-8')).hexdigest()
+                for code in (code1, code2)
+            )
+        else:
+            digests = [hashlib.sha256(code.encode('utf-8')).hexdigest() for code in (code1, code2)]
+        pair_digest = hashlib.sha256(':'.join(digests).encode('utf-8')).hexdigest()
+        return f'{kind}:{self.config_version}:{pair_digest}'
+    
+    def content_key(self, kind, code):
+        return f'{kind}:{self.config_version}:{hashlib.sha256(code.encode("utf-8")).hexdigest()}'
+    
+    @staticmethod
+    def etag(key):
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if not self.ttl or time.time() - stored_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.stats_counter['hits'] += 1
+                    RESULT_CACHE_LOOKUPS.labels(key.split(':', 1)[0], 'hit').inc()
+                    return value
+                del self._entries[key]
+            self.stats_counter['misses'] += 1
+            RESULT_CACHE_LOOKUPS.labels(key.split(':', 1)[0], 'miss').inc()
+            return None
+    
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats_counter['evictions'] += 1
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.stats_counter['hits'] + self.stats_counter['misses']
+            return {
+                'hits': self.stats_counter['hits'],
+                'misses': self.stats_counter['misses'],
+                'evictions': self.stats_counter['evictions'],
+                'hit_rate': round(self.stats_counter['hits'] / lookups, 4) if lookups else 0.0,
+                'entries': len(self._entries),
+                'config_version': self.config_version
+            }
+
+result_cache = ResultCache(
+    max_size=int(os.getenv('RESULT_CACHE_SIZE', 1024)),
+    ttl=int(os.getenv('RESULT_CACHE_TTL', 3600)),
+    config_version=scoring_config_version()
+)
+
+# Per-chunk fingerprints for incremental re-checks, keyed by chunk content
+chunk_cache = ResultCache(
+    max_size=int(os.getenv('CHUNK_CACHE_SIZE', 8192)),
+    ttl=int(os.getenv('CHUNK_CACHE_TTL', 86400)),
+    config_version=result_cache.config_version
+)
+INCREMENTAL_CHECK = os.getenv('INCREMENTAL_CHECK', 'false') == 'true'
+# One "provider" vocabulary for every comparison endpoint. 'local' is the offline embedder; 'remote'
+# is the hosted providers: both of them for pair comparisons, BATCH_EMBEDDING_PROVIDER for corpus
+# checks, where 'cohere' or 'together' pick the one embedding. Without API keys everything is local.
+EMBEDDING_PROVIDERS = ('remote', 'cohere', 'together', 'local')
+PROVIDER_KEYS_SET = bool(os.getenv('COHERE_API_KEY') or os.getenv('TOGETHER_API_KEY'))
+CHECK_EMBEDDING_PROVIDER = os.getenv('CHECK_EMBEDDING_PROVIDER') or ('remote' if PROVIDER_KEYS_SET else 'local')
+BATCH_EMBEDDING_PROVIDER = os.getenv('BATCH_EMBEDDING_PROVIDER') or ('cohere' if PROVIDER_KEYS_SET else 'local')
+
+def requested_provider(data, default):
+    """The request's "provider" in the shared vocabulary, or None when it is not one"""
+    provider = data.get('provider', default)
+    return provider if provider in EMBEDDING_PROVIDERS else None
+
+def function_spans(tree):
+    """(name, first line, last line) of top-level functions and class methods, decorators included"""
+    nodes = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            nodes.append((node.name, node))
+        elif isinstance(node, ast.ClassDef):
+            # Methods are chunks of their own so editing one leaves the rest of the class cached
+            nodes.extend(
+                (f'{node.name}.{member.name}', member) for member in node.body
+                if isinstance(member, (ast.FunctionDef, ast.AsyncFunctionDef))
+            )
+    return [
+        (name, min([node.lineno] + [decorator.lineno for decorator in node.decorator_list]), node.end_lineno)
+        for name, node in nodes
+    ]
+
+def split_into_chunks(code):
+    """Split code into top-level functions, class methods and one chunk of the remaining module lines"""
+    lines = code.split('\n')
+    try:
+        spans = function_spans(ast.parse(code))
+    except SyntaxError:
+        return [{'name': '<module>', 'start_line': 1, 'end_line': len(lines), 'code': code}]
+    
+    chunks = []
+    covered = bytearray(len(lines))
+    for name, start, end in spans:
+        covered[start - 1:end] = b'\x01' * (end - start + 1)
+        chunks.append({
+            'name': name,
+            'start_line': start,
+            'end_line': end,
+            # Dedented so a method hashes the same as the equivalent top-level function
+            'code': textwrap.dedent('\n'.join(lines[start - 1:end]))
+        })
+    
+    remainder = [line for line, used in zip(lines, covered) if not used]
+    if any(line.strip() for line in remainder):
+        chunks.insert(0, {'name': '<module>', 'start_line': 1, 'end_line': len(lines), 'code': '\n'.join(remainder)})
+    return chunks
+
+def window_lines(numbered_lines, name, max_lines, max_chars, overlap):
+    """Cut (line number, text) pairs into overlapping windows bounded by line count and characters"""
+    chunks = []
+    start = 0
+    while start < len(numbered_lines):
+        end = start
+        size = 0
+        while end < len(numbered_lines) and end - start < max_lines:
+            line_size = len(numbered_lines[end][1]) + 1
+            if size + line_size > max_chars and end > start:
+                break
+            size += line_size
+            end += 1
+        
+        # A single line longer than max_chars is cut, so payloads stay bounded
+        text = '\n'.join(line for _, line in numbered_lines[start:end])[:max_chars]
+        if text.strip():
+            chunks.append({
+                'name': name,
+                'start_line': numbered_lines[start][0],
+                'end_line': numbered_lines[end - 1][0],
+                'code': textwrap.dedent(text)
+            })
+        if end >= len(numbered_lines):
+            break
+        # When the character cap cuts a window short, the overlap shrinks with it: at most half the
+        # window repeats, so chunk text never exceeds twice the input
+        start = max(end - min(overlap, (end - start) // 2), start + 1)
+    return chunks
+
+def bounded_chunks(code, max_lines=None, max_chars=None, overlap=None, max_chunks=None):
+    """Function-level chunks of bounded size: long functions and module-level code become sliding windows
+    
+    Files that would need more than max_chunks chunks are cut again without overlap, and raise
+    ValueError if they still do.
+    """
+    max_lines = max_lines or CHUNK_MAX_LINES
+    max_chars = max_chars or CHUNK_MAX_CHARS
+    overlap = CHUNK_OVERLAP_LINES if overlap is None else overlap
+    max_chunks = max_chunks or CHUNK_MAX_CHUNKS
+    chunks = _bounded_chunks(code, max_lines, max_chars, overlap)
+    if len(chunks) > max_chunks and overlap:
+        chunks = _bounded_chunks(code, max_lines, max_chars, 0)
+    if len(chunks) > max_chunks:
+        raise ValueError(f'File needs {len(chunks)} chunks, more than the {max_chunks} allowed per file')
+    return chunks
+
+def _bounded_chunks(code, max_lines, max_chars, overlap):
+    lines = code.split('\n')
+    try:
+        spans = function_spans(ast.parse(code))
+    except SyntaxError:
+        spans = []
+    
+    chunks = []
+    covered = bytearray(len(lines))
+    group = []
+    for name, start, end in spans + [(None, len(lines) + 1, len(lines) + 1)]:
+        # Neighbouring short functions share a chunk, so chunk count tracks file length, not function count
+        if group and (name is None or end - group[0][1] + 1 > max_lines
+                      or sum(len(line) + 1 for line in lines[group[0][1] - 1:end]) > max_chars):
+            first, last = group[0][1], group[-1][2]
+            names = ', '.join(member[0] for member in group)
+            covered[first - 1:last] = b'\x01' * (last - first + 1)
+            chunks.extend(window_lines(list(enumerate(lines[first - 1:last], first)), names, max_lines, max_chars, overlap))
+            group = []
+        if name is not None:
+            group.append((name, start, end))
+    
+    # Module-level code, or the whole file when it does not parse; windows report the original line span
+    remainder = [(number, line) for number, line in enumerate(lines, 1) if not covered[number - 1] and line.strip()]
+    chunks.extend(window_lines(remainder, '<module>', max_lines, max_chars, overlap))
+    return chunks
+
+def chunk_fingerprints(chunks):
+    """File-level fingerprints assembled from per-chunk cache entries, fingerprinting only new chunks"""
+    merged = {}
+    for chunk in chunks:
+        key = chunk_cache.content_key('chunk', chunk['code'])
+        fingerprints = chunk_cache.get(key)
+        if fingerprints is None:
+            fingerprints = fingerprinter.fingerprint(chunk['code'])
+            chunk_cache.set(key, fingerprints)
+        for fingerprint in fingerprints:
+            merged.setdefault(fingerprint, chunk['start_line'])
+    return merged
+
+def combine_chunk_embeddings(chunks, embeddings):
+    """Unit-length file vector from unit chunk vectors weighted by chunk length"""
+    weights = np.array([len(chunk['code']) for chunk in chunks], dtype=np.float32)
+    return normalize_rows(weights @ normalize_rows(embeddings))[0]
+
+def best_match_score(matrix, weights1, weights2):
+    """Length-weighted mean of each chunk's best match in the other file, averaged over both directions"""
+    forward = weights1 @ matrix.max(axis=1) / weights1.sum()
+    backward = weights2 @ matrix.max(axis=0) / weights2.sum()
+    return float(forward + backward) / 2
+
+def matched_regions(chunks1, chunks2, matrix, threshold, limit):
+    """Best counterpart of each chunk of the first file, where it clears the threshold, strongest first"""
+    best = matrix.argmax(axis=1)
+    scores = matrix[np.arange(len(chunks1)), best]
+    regions = []
+    for i in np.argsort(-scores)[:limit]:
+        if scores[i] < threshold:
+            break
+        j = best[i]
+        regions.append({
+            'code1': {key: chunks1[i][key] for key in ('name', 'start_line', 'end_line')},
+            'code2': {key: chunks2[j][key] for key in ('name', 'start_line', 'end_line')},
+            'similarity': round(float(scores[i]) * 100, 2)
+        })
+    return regions
+
+def similarity_complete(results):
+    """Only results every provider answered are worth caching; degraded ones should be retried"""
+    return not results.get('TimedOut') and all(
+        results.get(provider) for provider in ('Cohere', 'TogetherAI') if provider in results
+    )
+
+def ai_detection_complete(detection, analysis):
+    """Detection worth caching: the semantic pass answered, or the code cannot be analyzed at all"""
+    if 'error' in detection:
+        return 'error' in analysis
+    return 'error' not in detection.get('semantic_analysis', {})
+
+def client_has_etag(etag):
+    """Whether If-None-Match names this exact tag; `*` is ignored, since it matches results never computed"""
+    return etag in request.if_none_match.as_set()
+
+def conditional_response(etag, payload=None, body=None):
+    """JSON response tagged with an ETag, or 304 when the client already holds that version"""
+    if client_has_etag(etag):
+        response = Response(status=304)
+    elif body is not None:
+        response = Response(body, mimetype='application/json')
+    else:
+        response = jsonify(payload)
+    response.set_etag(etag)
+    # Clients may keep the result but must revalidate before reusing it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def reinitialize_after_fork():
+    """Reset per-process state in forked gunicorn workers"""
+    global provider_executor, registration_executor, registration_slots
+    global http_session, cohere_client, _cohere_client_lock, _analysis_pool, _analysis_pool_lock
+    
+    # Locks may have been held by threads that do not exist in the child
+    provider_executor = ThreadPoolExecutor(
+        max_workers=int(os.getenv('PROVIDER_WORKERS', 16)),
+        thread_name_prefix='provider'
+    )
+    registration_executor = ThreadPoolExecutor(max_workers=REGISTRATION_WORKERS, thread_name_prefix='register')
+    registration_slots = threading.BoundedSemaphore(REGISTRATION_QUEUE)
+    # Pooled sockets must not be shared with the parent process
+    http_session = create_http_session()
+    cohere_client = None
+    _cohere_client_lock = threading.Lock()
+    _analysis_pool = None
+    _analysis_pool_lock = threading.Lock()
+    code_analyzer.ai_references._lock = threading.Lock()
+    
+    for batcher in (analyzer.cohere_batcher, analyzer.together_batcher):
+        if batcher is not None:
+            batcher.reinitialize_after_fork()
+    for breaker in circuit_breakers.values():
+        breaker.reinitialize_after_fork()
+    for store in (embedding_cache, result_cache, chunk_cache, fingerprint_index, subtree_index, submission_index, job_queue):
+        store.reinitialize_after_fork()
+
+# Startup side effects belong to the serving process, not to analysis worker processes
+if SERVING_PROCESS:
+    os.register_at_fork(after_in_child=reinitialize_after_fork)
+    
+    if os.getenv('PRELOAD_AI_REFERENCES') == 'true':
+        try:
+            code_analyzer.ai_references.matrix()
+        except Exception as e:
+            print(f"AI reference preload failed: {e}")
+
+SERVER_TIMING_HEADER = os.getenv('SERVER_TIMING_HEADER', 'false') == 'true'
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Export route latency and input size, and optionally the stage breakdown as a Server-Timing header"""
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    # Route templates, not raw paths, keep label cardinality bounded
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    
+    REQUEST_SECONDS.labels(route).observe(elapsed)
+    REQUESTS_TOTAL.labels(route, str(response.status_code)).inc()
+    if request.content_length:
+        REQUEST_INPUT_BYTES.labels(route).observe(request.content_length)
+    
+    if SERVER_TIMING_HEADER:
+        entries = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in g.get('stage_timings', {}).items()]
+        entries.append(f'total;dur={elapsed * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+    return response
 
 @app.route('/')
 def index():
@@ -441,7 +2814,7 @@ def index():
         return jsonify({
             'message': 'AI Code Plagiarism Detector API',
             'status': 'healthy',
-            'endpoints': ['/check', '/analyze', '/detailed-check', '/health']
+            'endpoints': ['/check', '/batch-check', '/batch-analyze', '/search', '/ingest', '/jobs', '/analyze', '/detailed-check', '/health', '/metrics']
         })
 
 @app.route('/<path:path>')
@@ -471,19 +2844,394 @@ def check_similarity():
         if not code1 or not code2:
             return jsonify({'error': 'Code snippets cannot be empty'}), 400
         
-        # Calculate similarities
-        results = analyzer.calculate_similarity(code1, code2)
+        provider = requested_provider(data, CHECK_EMBEDDING_PROVIDER)
+        if provider is None:
+            return jsonify({'error': f'Provider must be one of {list(EMBEDDING_PROVIDERS)}'}), 400
+        local = provider == 'local'
+        
+        # Chunked mode compares bounded chunks of large files and reports matched regions
+        longest = max(code1.count('\n'), code2.count('\n')) + 1
+        chunked = not local and bool(data.get('chunked', CHUNKED_CHECK_MIN_LINES and longest >= CHUNKED_CHECK_MIN_LINES))
+        # Incremental mode scores per-function chunks so resubmissions only redo edited functions
+        incremental = not local and not chunked and bool(data.get('incremental', INCREMENTAL_CHECK))
+        if local:
+            key = result_cache.pair_key('similarity_local', code1, code2)
+        elif chunked:
+            # Regions name each side, so the key keeps the order
+            key = result_cache.pair_key('similarity_chunked', code1, code2, symmetric=False)
+        else:
+            key = result_cache.pair_key('similarity_incremental' if incremental else 'similarity', code1, code2)
+        etag = result_cache.etag(key)
+        # ETags are only handed out for complete results, so a match needs no lookup at all
+        if client_has_etag(etag):
+            return conditional_response(etag)
+        
+        results = result_cache.get(key)
+        if results is None:
+            # Calculate similarities
+            if local:
+                results = analyzer.calculate_local_similarity(code1, code2)
+            elif chunked:
+                try:
+                    results = analyzer.calculate_chunked_similarity(code1, code2)
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+            elif incremental:
+                results = analyzer.calculate_incremental_similarity(code1, code2)
+            else:
+                results = analyzer.calculate_similarity(code1, code2)
+            # Local requests stay offline: only the fingerprint and subtree indexes
+            schedule_registration([code1, code2], embed=not local)
+            if not similarity_complete(results):
+                return jsonify(results)
+            result_cache.set(key, results)
         
-        return jsonify(results)
+        return conditional_response(etag, results)
     
     except Exception as e:
         print(f"Error in check_similarity: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/batch-check', methods=['POST'])
+def batch_check():
+    """All-pairs similarity across a corpus of submissions"""
+    try:
+        data = request.get_json()
+        
+        if not data or not isinstance(data.get('submissions'), list):
+            return jsonify({'error': 'Missing submissions list in request'}), 400
+        
+        # Accept plain strings or {"id": ..., "code": ...} objects
+        ids, codes = [], []
+        for position, submission in enumerate(data['submissions']):
+            if isinstance(submission, dict):
+                ids.append(str(submission.get('id', position)))
+                codes.append(str(submission.get('code', '')).strip())
+            else:
+                ids.append(str(position))
+                codes.append(str(submission).strip())
+        
+        if len(codes) < 2:
+            return jsonify({'error': 'At least two submissions are required'}), 400
+        if len(codes) > MAX_BATCH_SUBMISSIONS:
+            return jsonify({'error': f'At most {MAX_BATCH_SUBMISSIONS} submissions per request'}), 400
+        if not all(codes):
+            return jsonify({'error': 'Code snippets cannot be empty'}), 400
+        
+        provider = requested_provider(data, BATCH_EMBEDDING_PROVIDER)
+        if provider is None:
+            return jsonify({'error': f'Provider must be one of {list(EMBEDDING_PROVIDERS)}'}), 400
+        if provider == 'remote':
+            provider = BATCH_EMBEDDING_PROVIDER if BATCH_EMBEDDING_PROVIDER != 'local' else 'cohere'
+        
+        top_k = int(data.get('top_k', 5))
+        threshold = float(data.get('threshold', 80))
+        block_size = max(1, int(data.get('block_size', 1024)))
+        
+        if data.get('prefilter'):
+            min_jaccard = float(data.get('min_jaccard', 0.3))
+            batch = analyzer.candidate_similarity(codes, provider, top_k, threshold, min_jaccard)
+        else:
+            batch = analyzer.batch_similarity(codes, provider, top_k, threshold, block_size)
+        schedule_registration(codes, ids, embed=provider != 'local')
+        if batch['failed'] and not batch['matches']:
+            return jsonify({'error': 'Embedding provider unavailable'}), 503
+        
+        response = {
+            'provider': provider,
+            'count': len(codes),
+            'top_k': top_k,
+            'threshold': threshold,
+            'results': [
+                {
+                    'id': ids[i],
+                    'matches': [{'id': ids[j], 'score': score} for j, score in batch['matches'].get(i, [])]
+                }
+                for i in range(len(codes)) if i in batch['matches']
+            ],
+            'pairs': [
+                dict({'id1': ids[i], 'id2': ids[j], 'score': score}, **(details[0] if details else {}))
+                for i, j, score, *details in batch['pairs']
+            ],
+            'failed': [ids[i] for i in batch['failed']]
+        }
+        if 'candidates' in batch:
+            response['candidates'] = batch['candidates']
+        
+        return jsonify(response)
+    
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid batch parameters: {e}'}), 400
+    except Exception as e:
+        print(f"Error in batch_check: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/search', methods=['POST'])
+def search_submissions():
+    """Find the nearest previously checked submissions to a code snippet"""
+    try:
+        data = request.get_json()
+        
+        if not data or 'code' not in data:
+            return jsonify({'error': 'Missing code in request'}), 400
+        
+        code = data['code'].strip()
+        
+        if not code:
+            return jsonify({'error': 'Code cannot be empty'}), 400
+        
+        k = max(1, int(data.get('k', 10)))
+        exact = bool(data.get('exact', False))
+        
+        if data.get('method') in ('fingerprint', 'subtree'):
+            # Offline lookup through the winnowing or AST subtree inverted index
+            if data['method'] == 'subtree':
+                try:
+                    index, hashes = subtree_index, subtree_hasher.hashes(ast.parse(code))
+                except SyntaxError as e:
+                    return jsonify({'error': f'Syntax error: {str(e)}'}), 400
+            else:
+                index, hashes = fingerprint_index, fingerprinter.fingerprint(code)
+            results = index.lookup(hashes, k)
+            if data.get('register'):
+                schedule_registration([code], [data.get('id')])
+            return jsonify({
+                'method': data['method'],
+                'indexed': len(index),
+                'results': results
+            })
+        
+        embedding = get_index_embeddings([code])[0]
+        if embedding is None:
+            return jsonify({'error': 'Embedding provider unavailable'}), 503
+        
+        results, scanned = submission_index.search(embedding, k, exact)
+        
+        if data.get('register'):
+            schedule_registration([code], [data.get('id')])
+        
+        return jsonify({
+            'method': 'embedding',
+            'provider': SUBMISSION_INDEX_PROVIDER,
+            'exact': exact or not submission_index.stats()['trained'],
+            'candidates_scanned': scanned,
+            'indexed': len(submission_index),
+            'results': results
+        })
+    
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid search parameters: {e}'}), 400
+    except Exception as e:
+        print(f"Error in search_submissions: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/ingest', methods=['POST'])
+def ingest_archive():
+    """Analyze and cross-check every source file in an uploaded zip/tar archive, streaming results"""
+    use_sse = request.args.get('format') == 'sse'
+    pair_threshold = float(request.args.get('threshold', 50))
+    register = request.args.get('register') == 'true'
+    
+    def encode(event):
+        payload = dumps_json(event).decode('utf-8')
+        return f'data: {payload}\n\n' if use_sse else payload + '\n'
+    
+    def open_archive():
+        if 'archive' in request.files:
+            return request.files['archive'].stream, True
+        if 'zip' in (request.content_type or ''):
+            # Zip needs its central directory, so spool the body (to disk past 8 MB) before reading
+            spooled = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+            for chunk in iter(lambda: request.stream.read(64 * 1024), b''):
+                spooled.write(chunk)
+            spooled.seek(0)
+            return spooled, True
+        return request.stream, False
+    
+    def generate():
+        # Runs inside the streamed response, where the request context is still alive
+        started = time.monotonic()
+        seen = FingerprintIndex()
+        files = pairs = 0
+        
+        try:
+            fileobj, seekable = open_archive()
+            for name, source in iter_archive_sources(fileobj, seekable):
+                files += 1
+                analysis = code_analyzer.analyze_code_structure(source)
+                fingerprints = fingerprinter.fingerprint(source)
+                
+                event = {'type': 'file', 'name': name}
+                if 'error' in analysis:
+                    event['error'] = analysis['error']
+                else:
+                    event.update({
+                        'lines': analysis['lines_of_code'],
+                        'functions': len(analysis['functions']),
+                        'classes': len(analysis['classes']),
+                        'imports': len(analysis['imports']),
+                        'cyclomatic': analysis['complexity_metrics']['cyclomatic_complexity'],
+                        'ai_pattern_score': analysis['code_patterns']['ai_indicators']['score']
+                    })
+                yield encode(event)
+                
+                # Compare against every earlier file through the inverted index, not pairwise
+                for match in seen.lookup(fingerprints, k=len(seen)):
+                    if match['score'] < pair_threshold:
+                        break
+                    pairs += 1
+                    yield encode({'type': 'pair', 'file1': match['id'], 'file2': name, 'score': match['score']})
+                seen.add(name, fingerprints)
+                
+                if register:
+                    schedule_registration([source], [name])
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError) as e:
+            yield encode({'type': 'error', 'error': f'Unreadable archive: {e}'})
+        
+        yield encode({
+            'type': 'summary',
+            'files': files,
+            'pairs': pairs,
+            'elapsed_seconds': round(time.monotonic() - started, 3)
+        })
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream' if use_sse else 'application/x-ndjson'
+    )
+
+@app.route('/batch-analyze', methods=['POST'])
+def batch_analyze():
+    """Structure, style and AI-pattern analysis for many files, spread across worker processes"""
+    try:
+        data = request.get_json()
+        
+        if not data or not isinstance(data.get('submissions'), list):
+            return jsonify({'error': 'Missing submissions list in request'}), 400
+        
+        ids, codes = [], []
+        for position, submission in enumerate(data['submissions']):
+            if isinstance(submission, dict):
+                ids.append(str(submission.get('id', position)))
+                codes.append(str(submission.get('code', '')).strip())
+            else:
+                ids.append(str(position))
+                codes.append(str(submission).strip())
+        
+        if not codes:
+            return jsonify({'error': 'At least one submission is required'}), 400
+        if len(codes) > MAX_BATCH_SUBMISSIONS:
+            return jsonify({'error': f'At most {MAX_BATCH_SUBMISSIONS} submissions per request'}), 400
+        if not all(codes):
+            return jsonify({'error': 'Code snippets cannot be empty'}), 400
+        
+        chunk_size = data.get('chunk_size')
+        started = time.monotonic()
+        results = analyze_batch(codes, int(chunk_size) if chunk_size else None)
+        
+        return jsonify({
+            'count': len(codes),
+            'workers': ANALYSIS_WORKERS,
+            'elapsed_seconds': round(time.monotonic() - started, 3),
+            'results': [dict(result, id=submission_id) for submission_id, result in zip(ids, results)]
+        })
+    
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid batch parameters: {e}'}), 400
+    except Exception as e:
+        print(f"Error in batch_analyze: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """Queue a long-running comparison or AI-detection job"""
+    data = request.get_json(silent=True)
+    
+    if not data or data.get('type') not in job_queue.handlers:
+        return jsonify({'error': f"Job type must be one of {sorted(job_queue.handlers)}"}), 400
+    provider = requested_provider(data, CHECK_EMBEDDING_PROVIDER)
+    if provider is None:
+        return jsonify({'error': f'Provider must be one of {list(EMBEDDING_PROVIDERS)}'}), 400
+    
+    if data['type'] == 'compare':
+        pairs = data.get('pairs')
+        if not isinstance(pairs, list) or not pairs:
+            return jsonify({'error': 'Missing pairs list in request'}), 400
+        if not all(isinstance(p, dict) and str(p.get('code1', '')).strip() and str(p.get('code2', '')).strip()
+                   for p in pairs):
+            return jsonify({'error': 'Every pair needs non-empty code1 and code2'}), 400
+        payload = {'pairs': [
+            {'id': p.get('id', i), 'code1': str(p['code1']).strip(), 'code2': str(p['code2']).strip()}
+            for i, p in enumerate(pairs)
+        ]}
+    else:
+        codes = data.get('codes')
+        if not isinstance(codes, list) or not codes:
+            return jsonify({'error': 'Missing codes list in request'}), 400
+        if not all(isinstance(c, str) and c.strip() for c in codes):
+            return jsonify({'error': 'Code snippets cannot be empty'}), 400
+        payload = {'codes': [c.strip() for c in codes]}
+    
+    payload['provider'] = provider
+    job_id = job_queue.submit(data['type'], payload)
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': f'/jobs/{job_id}',
+        'result_url': f'/jobs/{job_id}/result'
+    }), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Status and progress of a queued job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Result of a finished job"""
+    job = job_queue.get(job_id, include_result=True)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] == 'failed':
+        return jsonify(job), 500
+    if job['status'] != 'completed':
+        return jsonify(job), 202
+    return jsonify(job)
+
+@app.route('/index/stats')
+def index_stats():
+    """Submission index size, layout and (optionally) measured recall"""
+    stats = submission_index.stats()
+    if request.args.get('recall'):
+        k = int(request.args.get('k', 10))
+        stats['recall_at_k'] = round(submission_index.measure_recall(k, int(request.args.get('samples', 100))), 4)
+        stats['k'] = k
+    return jsonify(stats)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics, aggregated across gunicorn workers when PROMETHEUS_MULTIPROC_DIR is set"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'message': 'AI Code Plagiarism Detector is running'})
+    return jsonify({
+        'status': 'healthy',
+        'message': 'AI Code Plagiarism Detector is running',
+        'embedding_cache': embedding_cache.stats(),
+        'result_cache': result_cache.stats(),
+        'chunk_cache': chunk_cache.stats(),
+        'providers': {name: breaker.stats() for name, breaker in circuit_breakers.items()}
+    })
 
 @app.route('/analyze', methods=['POST'])
 def analyze_code():
@@ -498,12 +3246,13 @@ def analyze_code():
         
         if not code:
             return jsonify({'error': 'Code cannot be empty'}), 400
+        compact = bool(data.get('compact'))
         
         # Perform comprehensive analysis
         analysis_result = code_analyzer.analyze_code_structure(code)
-        ai_detection_result = code_analyzer.detect_ai_generated_code(code)
+        ai_detection_result = code_analyzer.detect_ai_generated_code(code, analysis_result)
         
-        # Combine results and convert numpy types
+        # Combine results
         result = {
             'structure': {
                 'lines': analysis_result.get('lines_of_code', 0),
@@ -530,11 +3279,14 @@ def analyze_code():
             'insights': generate_single_code_insights(analysis_result, ai_detection_result),
             'timestamp': datetime.now().isoformat()
         }
+        if compact:
+            # Summary numbers only: per-function records and the style breakdown dominate the payload
+            del result['structure']['function_details'], result['structure']['class_details'], result['style']
         
-        # Convert any numpy types to native Python types
-        result = convert_numpy_types(result)
+        with timed_stage('serialize'):
+            response = jsonify(result)
         
-        return jsonify(result)
+        return response
     
     except Exception as e:
         print(f"Error in analyze_code: {e}")
@@ -555,23 +3307,46 @@ def detailed_similarity_check():
         if not code1 or not code2:
             return jsonify({'error': 'Code snippets cannot be empty'}), 400
         
-        # Basic similarity check
-        similarity_results = analyzer.calculate_similarity(code1, code2)
+        provider = requested_provider(data, CHECK_EMBEDDING_PROVIDER)
+        if provider is None:
+            return jsonify({'error': f'Provider must be one of {list(EMBEDDING_PROVIDERS)}'}), 400
+        local = provider == 'local'
+        
+        compact = bool(data.get('compact'))
+        kind = 'detailed_compact' if compact else 'detailed'
+        # Both sides are reported separately, so the key keeps their order
+        detailed_key = result_cache.pair_key(kind + '_local' if local else kind, code1, code2, symmetric=False)
+        etag = result_cache.etag(detailed_key)
+        if client_has_etag(etag):
+            return conditional_response(etag)
+        cached_body = result_cache.get(detailed_key)
+        if cached_body is not None:
+            return conditional_response(etag, body=cached_body)
+        
+        # Basic similarity check, shared with /check and independent of order
+        similarity_key = result_cache.pair_key('similarity_local' if local else 'similarity', code1, code2)
+        similarity_results = result_cache.get(similarity_key)
+        if similarity_results is None:
+            similarity_results = analyzer.calculate_similarity(code1, code2, provider)
+            schedule_registration([code1, code2], embed=not local)
+            if similarity_complete(similarity_results):
+                result_cache.set(similarity_key, similarity_results)
         
         # Detailed analysis for both codes
         analysis1 = code_analyzer.analyze_code_structure(code1)
         analysis2 = code_analyzer.analyze_code_structure(code2)
         
         # AI detection for both codes
-        ai_detection1 = code_analyzer.detect_ai_generated_code(code1)
-        ai_detection2 = code_analyzer.detect_ai_generated_code(code2)
+        ai_detection1 = code_analyzer.detect_ai_generated_code(code1, analysis1, semantic=not local)
+        ai_detection2 = code_analyzer.detect_ai_generated_code(code2, analysis2, semantic=not local)
         
         # Advanced similarity metrics
-        detailed_comparison = {
-            'structural_similarity': calculate_structural_similarity(analysis1, analysis2),
-            'complexity_comparison': compare_complexity(analysis1, analysis2),
-            'style_similarity': compare_code_style(analysis1, analysis2)
-        }
+        with timed_stage('comparison'):
+            detailed_comparison = {
+                'structural_similarity': calculate_structural_similarity(analysis1, analysis2),
+                'complexity_comparison': compare_complexity(analysis1, analysis2),
+                'style_similarity': compare_code_style(analysis1, analysis2)
+            }
         
         result = {
             'similarity': {
@@ -580,7 +3355,8 @@ def detailed_similarity_check():
                     'cohere': float(similarity_results.get('Cohere', 0)),
                     'together': float(similarity_results.get('TogetherAI', 0)),
                     'replicate': float(similarity_results.get('Replicate', 0))
-                }
+                },
+                'timed_out': similarity_results.get('TimedOut', [])
             },
             'code1_analysis': {
                 'structure': {
@@ -622,13 +3398,28 @@ def detailed_similarity_check():
                     'confidence': float(ai_detection2.get('ai_probability', 0))
                 }
             },
+            'detailed_comparison': detailed_comparison,
             'comparison_insights': generate_comparison_insights(analysis1, analysis2, similarity_results)
         }
+        if local:
+            # No hosted provider was asked, so their zeros would read as a verdict
+            result['similarity']['individual_scores'] = {
+                'local': float(similarity_results.get('Local', 0)),
+                'replicate': float(similarity_results.get('Replicate', 0))
+            }
+        if compact:
+            del result['code1_analysis']['style'], result['code2_analysis']['style']
         
-        # Convert any numpy types to native Python types
-        result = convert_numpy_types(result)
+        with timed_stage('serialize'):
+            response = jsonify(result)
         
-        return jsonify(result)
+        # A degraded AI verdict (reference samples or embeddings unavailable) must not be pinned either
+        if not (similarity_complete(similarity_results) and ai_detection_complete(ai_detection1, analysis1)
+                and ai_detection_complete(ai_detection2, analysis2)):
+            return response
+        # Stored serialized, so a repeat comparison skips analysis and encoding alike
+        result_cache.set(detailed_key, response.get_data())
+        return conditional_response(etag, body=response.get_data())
     
     except Exception as e:
         print(f"Error in detailed_similarity_check: {e}")
@@ -676,6 +3467,15 @@ def calculate_structural_similarity(analysis1, analysis2):
         similarity_score += loc_similarity * 0.3
         details['loc_similarity'] = loc_similarity
     
+    # Shared rename-invariant subtrees separate copied logic from matching counts
+    subtrees1 = analysis1.get('subtree_hashes', {})
+    subtrees2 = analysis2.get('subtree_hashes', {})
+    if subtrees1 or subtrees2:
+        subtree_similarity = SubtreeHasher.similarity(subtrees1, subtrees2) / 100
+        similarity_score = similarity_score * 0.5 + subtree_similarity * 0.5
+        details['subtree_similarity'] = subtree_similarity
+        details['shared_subtrees'] = len(subtrees1.keys() & subtrees2.keys())
+    
     return {
         'score': round(similarity_score * 100, 2),
         'details': details
@@ -919,22 +3719,6 @@ def generate_single_code_insights(analysis, ai_detection):
     
     return insights
 
-def convert_numpy_types(obj):
-    """Convert numpy types to Python native types for JSON serialization"""
-    if isinstance(obj, np.integer):
-        return int(obj)
-    elif isinstance(obj, np.floating):
-        return float(obj)
-    elif isinstance(obj, np.ndarray):
-        return obj.tolist()
-    elif isinstance(obj, np.bool_):
-        return bool(obj)
-    elif isinstance(obj, dict):
-        return {key: convert_numpy_types(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_numpy_types(item) for item in obj]
-    return obj
-
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     host = os.environ.get('HOST', '0.0.0.0')
@@ -956,4 +3740,8 @@ if __name__ == '__main__':
     print("🔗 CORS enabled for frontend integration")
     print("✅ Ready to detect code plagiarism!")
     
+    # Under gunicorn the post_fork hook starts the sweeper; the debug reloader's parent runs no jobs
+    if not debug_mode or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        job_queue.start()
+    
     app.run(host=host, port=port, debug=debug_mode)
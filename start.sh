@@ -9,5 +9,5 @@ pip install -r requirements.txt
 # Set environment variables for production
 export FLASK_ENV=production
 
-# Start the Flask application
-python main.py
+# Start the Flask application with pre-forked workers
+exec gunicorn -c gunicorn.conf.py main:app